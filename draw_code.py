@@ -7,6 +7,8 @@ import tensorflow as tf
 from tensorflow.examples.tutorials import mnist
 import numpy as np
 import os
+import draw_store
+import frozen_graph
 
 
 #define flags
@@ -14,6 +16,8 @@ import os
 tf.flags.DEFINE_string("data_dir", "", "")
 tf.flags.DEFINE_boolean("read_attn", True, "enable attention for reader")
 tf.flags.DEFINE_boolean("write_attn",True, "enable attention for writer")
+tf.flags.DEFINE_boolean("symbolic_loop",False, "build the T steps with tf.while_loop, T can then be fed at run time")
+tf.flags.DEFINE_string("export_graph","", "after training, write the frozen canvas graph (x -> canvases) to this file")
 FLAGS = tf.flags.FLAGS
 
 ## MODEL PARAMETERS ## 
@@ -39,7 +43,7 @@ DO_SHARE=None # workaround for variable_scope(reuse=True)
 
 #initialize les 4 elements TF
 
-x = tf.placeholder(tf.float32,shape=(batch_size,img_size)) # input (batch_size * img_size)
+x = tf.placeholder(tf.float32,shape=(batch_size,img_size),name="x") # input (batch_size * img_size)
 e=tf.random_normal((batch_size,z_size), mean=0, stddev=1) # Qsampler noise
 lstm_enc = tf.contrib.rnn.LSTMCell(enc_size, state_is_tuple=True) # encoder Op
 lstm_dec = tf.contrib.rnn.LSTMCell(dec_size, state_is_tuple=True) # decoder Op
@@ -53,12 +57,19 @@ def linear(x,output_dim): #function that compute w and b
     b=tf.get_variable("b", [output_dim], initializer=tf.constant_initializer(0.0))
     return tf.matmul(x,w)+b
 
+## FILTERBANK GRIDS ##
+
+# built once and shared by all T timesteps, instead of being rebuilt by every filterbank call
+grid_a = tf.reshape(tf.cast(tf.range(A), tf.float32), [1, 1, -1])
+grid_b = tf.reshape(tf.cast(tf.range(B), tf.float32), [1, 1, -1])
+grid_n = dict((N, tf.reshape(tf.cast(tf.range(N), tf.float32), [1, -1])) for N in set([read_n, write_n]))
+
 def filterbank(gx, gy, sigma2,delta, N):
-    grid_i = tf.reshape(tf.cast(tf.range(N), tf.float32), [1, -1])
+    grid_i = grid_n[N]
     mu_x = gx + (grid_i - N / 2 - 0.5) * delta # eq 19
     mu_y = gy + (grid_i - N / 2 - 0.5) * delta # eq 20
-    a = tf.reshape(tf.cast(tf.range(A), tf.float32), [1, 1, -1])
-    b = tf.reshape(tf.cast(tf.range(B), tf.float32), [1, 1, -1])
+    a = grid_a
+    b = grid_b
     mu_x = tf.reshape(mu_x, [-1, N, 1])
     mu_y = tf.reshape(mu_y, [-1, N, 1])
     sigma2 = tf.reshape(sigma2, [-1, 1, 1])
@@ -86,15 +97,17 @@ def read_no_attn(x,x_hat,h_dec_prev):
 
 def read_attn(x,x_hat,h_dec_prev):
     Fx,Fy,gamma=attn_window("read",h_dec_prev,read_n)
-    def filter_img(img,Fx,Fy,gamma,N):
-        Fxt=tf.transpose(Fx,perm=[0,2,1])
-        img=tf.reshape(img,[-1,B,A])
-        glimpse=tf.matmul(Fy,tf.matmul(img,Fxt))
-        glimpse=tf.reshape(glimpse,[-1,N*N])
-        return glimpse*tf.reshape(gamma,[-1,1])
-    x=filter_img(x,Fx,Fy,gamma,read_n) # batch x (read_n*read_n)
-    x_hat=filter_img(x_hat,Fx,Fy,gamma,read_n)
-    return tf.concat([x,x_hat], 1) # concat along feature axis
+    N=read_n
+    # filter x and x_hat together: one batched matmul with Fx and one with Fy cover both images
+    img=tf.reshape(tf.stack([x,x_hat],1),[-1,2*B,A]) # batch x (2*B) x A
+    Fxt=tf.transpose(Fx,perm=[0,2,1])
+    glimpse=tf.reshape(tf.matmul(img,Fxt),[-1,2,B,N])
+    glimpse=tf.reshape(tf.transpose(glimpse,perm=[0,2,1,3]),[-1,B,2*N]) # batch x B x (2*N)
+    glimpse=tf.reshape(tf.matmul(Fy,glimpse),[-1,N,2,N])
+    glimpse=tf.transpose(glimpse,perm=[0,2,1,3]) # batch x 2 x N x N
+    # same layout as concatenating the x and x_hat glimpses along the feature axis
+    glimpse=tf.reshape(glimpse,[-1,2*N*N])
+    return glimpse*tf.reshape(gamma,[-1,1])
 
 read = read_attn if FLAGS.read_attn else read_no_attn
 
@@ -158,17 +171,48 @@ dec_state=lstm_dec.zero_state(batch_size, tf.float32)
 
 ## DRAW MODEL ## 
 
-# construct the unrolled computational graph
-for t in range(T):
-    c_prev = tf.zeros((batch_size,img_size)) if t==0 else cs[t-1]
+def draw_step(c_prev,h_dec_prev,enc_state,dec_state):
+    """
+    one glimpse: read, encode, sample, decode and write
+    returns the new canvas, decoder output and LSTM states, and the SampleQ gaussian params
+    """
     x_hat=x-tf.sigmoid(c_prev) # error image
     r=read(x,x_hat,h_dec_prev)
     h_enc,enc_state=encode(enc_state,tf.concat([r,h_dec_prev], 1))
-    z,mus[t],logsigmas[t],sigmas[t]=sampleQ(h_enc)
+    z,mu,logsigma,sigma=sampleQ(h_enc)
     h_dec,dec_state=decode(dec_state,z)
-    cs[t]=c_prev+write(h_dec) # store results
-    h_dec_prev=h_dec
-    DO_SHARE=True # from now on, share variables
+    c=c_prev+write(h_dec)
+    return c,h_dec,enc_state,dec_state,mu,logsigma,sigma
+
+def kl_term(mu,logsigma,sigma):
+    mu2=tf.square(mu)
+    sigma2=tf.square(sigma)
+    return 0.5*tf.reduce_sum(mu2+sigma2-2*logsigma,1)-.5 # each kl term is (1xminibatch)
+
+if FLAGS.symbolic_loop:
+    # one loop body with shared variables, the number of steps is a tensor (T unless fed)
+    num_steps=tf.placeholder_with_default(T,shape=[],name="T")
+
+    def loop_cond(t,c_prev,h_dec_prev,enc_state,dec_state,canvases,KL):
+        return t<num_steps
+
+    def loop_body(t,c_prev,h_dec_prev,enc_state,dec_state,canvases,KL):
+        c,h_dec,enc_state,dec_state,mu,logsigma,sigma=draw_step(c_prev,h_dec_prev,enc_state,dec_state)
+        return t+1,c,h_dec,enc_state,dec_state,canvases.write(t,c),KL+kl_term(mu,logsigma,sigma)
+
+    loop_vars=(tf.constant(0),tf.zeros((batch_size,img_size)),h_dec_prev,enc_state,dec_state,
+               tf.TensorArray(tf.float32,size=num_steps),tf.zeros((batch_size,)))
+    _,c_last,_,_,_,canvases,KL=tf.while_loop(loop_cond,loop_body,loop_vars)
+    cs=canvases.stack() # T x batch x img_size
+    DO_SHARE=True
+else:
+    # construct the unrolled computational graph
+    for t in range(T):
+        c_prev = tf.zeros((batch_size,img_size)) if t==0 else cs[t-1]
+        cs[t],h_dec_prev,enc_state,dec_state,mus[t],logsigmas[t],sigmas[t]=draw_step(c_prev,h_dec_prev,enc_state,dec_state) # store results
+        DO_SHARE=True # from now on, share variables
+    c_last=cs[-1]
+    KL=tf.add_n([kl_term(mus[t],logsigmas[t],sigmas[t]) for t in range(T)]) # this is 1xminibatch, corresponding to summing kl_terms from 1:T
 
 ## LOSS FUNCTION ## 
 
@@ -176,19 +220,12 @@ def binary_crossentropy(t,o):
     return -(t*tf.log(o+eps) + (1.0-t)*tf.log(1.0-o+eps))
 
 # reconstruction term appears to have been collapsed down to a single scalar value (rather than one per item in minibatch)
-x_recons=tf.nn.sigmoid(cs[-1])
+x_recons=tf.nn.sigmoid(c_last)
 
 # after computing binary cross entropy, sum across features then take the mean of those sums across minibatches
 Lx=tf.reduce_sum(binary_crossentropy(x,x_recons),1) # reconstruction term
 Lx=tf.reduce_mean(Lx)
 
-kl_terms=[0]*T
-for t in range(T):
-    mu2=tf.square(mus[t])
-    sigma2=tf.square(sigmas[t])
-    logsigma=logsigmas[t]
-    kl_terms[t]=0.5*tf.reduce_sum(mu2+sigma2-2*logsigma,1)-.5 # each kl term is (1xminibatch)
-KL=tf.add_n(kl_terms) # this is 1xminibatch, corresponding to summing kl_terms from 1:T
 Lz=tf.reduce_mean(KL) # average over minibatches
 
 cost=Lx+Lz
@@ -209,10 +246,11 @@ if not os.path.exists(data_directory):
 	os.makedirs(data_directory)
 train_data = mnist.input_data.read_data_sets(data_directory, one_hot=True).train # binarized (0-1) mnist data
 
+out_dir=os.path.join(FLAGS.data_dir,"draw_data")
+
 fetches=[]
 fetches.extend([Lx,Lz,train_op])
-Lxs=[0]*train_iters
-Lzs=[0]*train_iters
+Lxs,Lzs=draw_store.open_losses(out_dir,train_iters) # float32, written as training goes
 
 sess=tf.InteractiveSession()
 
@@ -230,14 +268,31 @@ for i in range(train_iters):
 
 ## TRAINING FINISHED ## 
 
-canvases=sess.run(cs,feed_dict) # generate some examples
-canvases=np.array(canvases) # T x batch x img_size
+canvases=sess.run(cs,feed_dict) # generate some examples (with symbolic_loop, feed num_steps to change T)
 
-out_file=os.path.join(FLAGS.data_dir,"draw_data.npy")
-np.save(out_file,[canvases,Lxs,Lzs])
-print("Outputs saved in file: %s" % out_file)
+# the fetched canvases (all T steps are in memory once sess.run returns) are streamed to disk
+# one time step at a time, into a T x batch x img_size float32 array
+canvas_store=draw_store.open_canvases(out_dir,len(canvases),batch_size,img_size)
+for t,canvas in enumerate(canvases):
+	canvas_store[t]=canvas
+canvas_store.flush()
+Lxs.flush()
+Lzs.flush()
+print("Outputs saved in directory: %s" % out_dir)
 
 ckpt_file=os.path.join(FLAGS.data_dir,"drawmodel.ckpt")
 print("Model saved in file: %s" % saver.save(sess,ckpt_file))
 
+if FLAGS.export_graph:
+	# only the canvas sequence is kept, without the losses, the optimizer and its slots
+	canvas_op=tf.identity(cs,name="canvases") if FLAGS.symbolic_loop else tf.stack(cs,name="canvases")
+	n_nodes=frozen_graph.export(sess,[canvas_op.op.name],FLAGS.export_graph)
+	print("Frozen graph (%d nodes) saved in file: %s" % (n_nodes,FLAGS.export_graph))
+	# the QSampler noise is fed as well, so that both graphs draw the same canvases
+	noise=np.random.normal(size=(batch_size,z_size)).astype(np.float32)
+	difference,=frozen_graph.check(sess,FLAGS.export_graph,[canvas_op.op.name],{x.name:xtrain,e.name:noise})
+	if difference>1e-4:
+		raise ValueError("frozen graph canvases differ from the trained model (max relative difference %g)" % difference)
+	print("Frozen graph canvases match the trained model (max relative difference %g)" % difference)
+
 sess.close()
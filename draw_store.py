@@ -0,0 +1,38 @@
+# typed, memory-mappable storage for the outputs of draw_code.py, read back by plot_draw.py
+#
+# <out_dir>/canvases.npy   float32, T x batch_size x img_size, written one time step at a time
+# <out_dir>/Lxs.npy        float32, reconstruction loss of every training iteration
+# <out_dir>/Lzs.npy        float32, latent loss of every training iteration
+#
+# every file is a plain .npy array, so a reader can memory-map it and only touch
+# the time steps or the slice of the batch it looks at, i.e. load(out_dir)[0][t, :64]
+
+import os
+import numpy as np
+
+
+def open_canvases(out_dir,T,batch_size,img_size):
+	"""
+	creates canvases.npy and returns it as a writable memmap
+	store time step t with canvases[t]=..., then flush() or del it
+	"""
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	return np.lib.format.open_memmap(os.path.join(out_dir,'canvases.npy'),mode='w+',
+		dtype=np.float32,shape=(T,batch_size,img_size))
+
+def open_losses(out_dir,train_iters):
+	"""
+	creates Lxs.npy and Lzs.npy and returns them as writable memmaps of length train_iters
+	"""
+	if not os.path.exists(out_dir):
+		os.makedirs(out_dir)
+	return [np.lib.format.open_memmap(os.path.join(out_dir,'%s.npy' % name),mode='w+',
+		dtype=np.float32,shape=(train_iters,)) for name in ('Lxs','Lzs')]
+
+def load(out_dir,mmap_mode='r'):
+	"""
+	returns canvases, Lxs, Lzs, memory-mapped unless mmap_mode is None
+	"""
+	return [np.load(os.path.join(out_dir,'%s.npy' % name),mmap_mode=mmap_mode)
+		for name in ('canvases','Lxs','Lzs')]
@@ -0,0 +1,53 @@
+# frozen inference graphs for ram.py and draw_code.py
+#
+# export() turns the variables the requested outputs depend on into constants and drops every other node
+# (optimizer slots, summaries, the reconstruction head, ...). The result is a single self-contained GraphDef
+# file that load() imports without a checkpoint, a Saver or variable initialization. check() runs the exported file
+# and the live session on the same inputs, so an export that does not import or computes something else is caught.
+
+import os
+import numpy as np
+import tensorflow as tf
+
+# ops of tf.cond / tf.while_loop frames; remove_training_nodes splices out the Identity nodes between them
+CONTROL_FLOW_OPS = {'Switch', 'Merge', 'Enter', 'Exit', 'NextIteration', 'LoopCond'}
+
+def export(sess, output_names, path):
+    '''
+    Freeze the graph of sess for the ops in output_names and write it to path (binary GraphDef)
+    :return: the number of nodes in the exported graph
+    '''
+    graph_def = sess.graph.as_graph_def()
+    # keeps only the ancestors of the outputs, the variables among them become constants
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, graph_def, output_names)
+    if not any(node.op in CONTROL_FLOW_OPS for node in graph_def.node):
+        graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+    tf.train.write_graph(graph_def, os.path.dirname(path) or '.', os.path.basename(path), as_text=False)
+    return len(graph_def.node)
+
+
+def load(path, name=''):
+    '''
+    Import a graph written by export() into a new tf.Graph, with its op names under the scope name
+    '''
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name=name)
+    return graph
+
+
+def check(sess, path, output_names, feed_dict):
+    '''
+    Run the graph written by export() to path, imported with load(), and the graph of sess on the same inputs
+    :param feed_dict: maps tensor names (e.g. "images:0") to the values fed to both graphs
+    :return: for every output, the largest difference between the two results, relative to the largest magnitude of
+    the live result when that is above 1 (float rounding grows with it, e.g. DRAW canvases reach a few hundred)
+    '''
+    fetches = [name + ':0' for name in output_names]
+    with tf.Session(graph=load(path)) as frozen_sess:
+        frozen = frozen_sess.run(fetches, feed_dict)
+    live = sess.run(fetches, feed_dict)
+    return [float(np.max(np.abs(f - l)) / max(np.max(np.abs(l)), 1.0)) for f, l in zip(frozen, live)]
@@ -100,4 +100,4 @@ class LocNet(object):
 
   @sampling.setter
   def sampling(self, sampling):
-self._sampling = sampling
+    self._sampling = sampling
@@ -2,7 +2,9 @@ import os
 import sys
 import argparse
 import collections
+import collections.abc
 import json
+import multiprocessing
 import re
 from datetime import datetime
 
@@ -18,237 +20,343 @@ id_to_ans = {}
 img_dir = 'CLEVR_v1.0/images/train/'
 # question_dir = '/Users/larrychen/Downloads/CLEVR_v1.0/questions/CLEVR_train_questions.json'
 question_dir = 'CLEVR_v1.0/questions/CLEVR_train_questions.json'
+# shard index written by serialize_examples
+example_index = 'data/train_examples.index.json'
+# res_net output of every training image, written once by extract_features
+feature_file = 'data/train_features.npy'
+# float32 word vectors converted once from data/embeddings.json by convert_embeddings
+embedding_store = 'data/embeddings.npy'
+batch_size = 32
 pretrained = {}
 
 date = datetime.now()
 date_string = date.strftime('%Y-%m-%d-%H-%M-%S')
 
-def build_embeddings(embedding_file, vocab_file):
+def convert_embeddings(embedding_file, vocab_file, output_file):
+    """Converts the word vectors in embedding_file to a float32 matrix stored as output_file (.npy).
+
+    Row i holds the vector of the i-th word of vocab_file, row 0 is the <PAD> token and stays zero. The
+    words are written in row order to output_file + '.vocab.json'. This only has to run once, afterwards
+    load_embeddings memory-maps the matrix.
+    """
     model = json.load(open(embedding_file))
     vocabulary = [word.strip() for word in open(vocab_file)]
+    vocabulary[0] = '<PAD>'
 
     embedding_dim = len(model[vocabulary[1]][0])
 
-    embedding = np.zeros((len(vocabulary), embedding_dim))
-    dictionary = {'<PAD>': 0}
-    reverse_dictionary = {0: '<PAD>'}
+    tmp_file = output_file + '.tmp.npy'
+    embedding = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                          shape=(len(vocabulary), embedding_dim))
+    embedding[0] = 0
     for i, word in enumerate(vocabulary[1:]):
-        vec = np.asarray(model[word]).reshape(1, embedding_dim)
-        embedding[i + 1] = vec
-        reverse_dictionary[i + 1] = word
-        dictionary[word] = i + 1
+        embedding[i + 1] = np.asarray(model[word], dtype=np.float32).reshape(embedding_dim)
+    embedding.flush()
+    del embedding
+    with open(output_file + '.vocab.json', 'w') as fp:
+        json.dump(vocabulary, fp)
+    os.rename(tmp_file, output_file)
+
+
+def load_embeddings(embedding_file):
+    """Memory-maps an embedding matrix written by convert_embeddings.
+
+    Returns the (read-only) matrix and the word to row and row to word dictionaries.
+    """
+    embedding = np.load(embedding_file, mmap_mode='r')
+    with open(embedding_file + '.vocab.json') as fp:
+        vocabulary = json.load(fp)
+    dictionary = dict((word, i) for i, word in enumerate(vocabulary))
+    reverse_dictionary = dict(enumerate(vocabulary))
     return embedding, dictionary, reverse_dictionary
 
 
-def extract_pretrained_weights(checkpoint_file):
+
+def pretrained_name(tensor_name):
+    """Translates a tensor name of the slim resnet_v1_101 checkpoint to the scope name used by res_net."""
+    if tensor_name == 'resnet_v1_101/logits/weights':
+        return 'fully_connected/weights'
+    if tensor_name == 'resnet_v1_101/logits/biases':
+        return 'fully_connected/biases'
+    info_dict = re.search(
+        r'((block(?P<block>\d))/(unit_(?P<unit>\d+))/bottleneck_v1/)?(?P<branch>conv\d+|shortcut)/(BatchNorm/)?(?P<tensor>weights|gamma|beta|moving_mean|moving_variance)',
+        tensor_name)
+    if info_dict is None:
+        return None
+    else:
+        info_dict = info_dict.groupdict()
+    if info_dict['block'] is None:
+        layer = 'res1'
+        block = ''
+        branch = ''
+        conv = ''
+    else:
+        layer = 'res%d' % (int(info_dict['block']) + 1)
+        block = 'block%d' % int(info_dict['unit'])
+        branch = 'branch1' if info_dict['branch'] == 'shortcut' else 'branch2'
+        conv = 0 if info_dict['branch'] == 'shortcut' else int(info_dict['branch'][-1])
+        conv = '' if conv == 0 else str(chr(96 + conv))
+    tensor = 'weights' if info_dict['tensor'] == 'weights' else 'batch_normalization/' + info_dict['tensor']
+    return os.path.join(layer, block, branch, conv, tensor)
+
+
+def cache_pretrained_weights(checkpoint_file, archive_file, alignment=64):
+    """Writes the pretrained tensors of checkpoint_file back to back to the flat binary archive_file.
+
+    archive_file + '.index.json' maps every translated scope name to the offset, shape and dtype of its
+    tensor. Offsets are multiples of alignment bytes.
+    """
     from tensorflow.python import pywrap_tensorflow
     reader = pywrap_tensorflow.NewCheckpointReader(checkpoint_file)
-    tensors = reader.get_variable_to_shape_map().keys()
-    for t in tensors:
-        info_dict = re.search(
-            r'((block(?P<block>\d))/(unit_(?P<unit>\d+))/bottleneck_v1/)?(?P<branch>conv\d+|shortcut)/(BatchNorm/)?(?P<tensor>weights|gamma|beta|moving_mean|moving_variance)',
-            t)
-        if info_dict is None:
-            continue
-        else:
-            info_dict = info_dict.groupdict()
-        if info_dict['block'] is None:
-            layer = 'res1'
-            block = ''
-            branch = ''
-            conv = ''
-        else:
-            layer = 'res%d' % (int(info_dict['block']) + 1)
-            block = 'block%d' % int(info_dict['unit'])
-            branch = 'branch1' if info_dict['branch'] == 'shortcut' else 'branch2'
-            conv = 0 if info_dict['branch'] == 'shortcut' else int(info_dict['branch'][-1])
-            conv = '' if conv == 0 else str(chr(96 + conv))
-        tensor = 'weights' if info_dict['tensor'] == 'weights' else 'batch_normalization/' + info_dict['tensor']
-        name_scope = os.path.join(layer, block, branch, conv, tensor)
-        pretrained[name_scope] = reader.get_tensor(t)
-    pretrained['fully_connected/weights'] = reader.get_tensor('resnet_v1_101/logits/weights')
-    pretrained['fully_connected/biases'] = reader.get_tensor('resnet_v1_101/logits/biases')
-
-
-def serialize_examples(question_file, dictionary):
-    def update_progress(current, total, task):
-        bar_length = 50
-        text = ''
-        progress = float(current) / total
-        num_dots = int(round(bar_length * progress))
-        num_spaces = bar_length - num_dots
-        if current == total:
-            text = '\r\nDone.\r\n'
-        else:
-            text = ('\r[{}] {:.2f}% ' + task + ' {} of {}').format('.' * num_dots + ' ' * num_spaces, progress * 100,
-                                                                   current, total)
-        sys.stdout.write(text)
-        sys.stdout.flush()
+    index = {}
+    tmp_file = archive_file + '.tmp'
+    with open(tmp_file, 'wb') as fp:
+        for t in sorted(reader.get_variable_to_shape_map().keys()):
+            name_scope = pretrained_name(t)
+            if name_scope is None:
+                continue
+            value = np.ascontiguousarray(reader.get_tensor(t))
+            fp.write(b'\0' * (-fp.tell() % alignment))
+            index[name_scope] = {'offset': fp.tell(), 'shape': list(value.shape), 'dtype': value.dtype.str}
+            fp.write(value.tobytes())
+    with open(archive_file + '.index.json', 'w') as fp:
+        json.dump(index, fp)
+    os.rename(tmp_file, archive_file)
+
+
+class PretrainedWeights(collections.abc.Mapping):
+    """Read-only mapping from scope names to the tensors in an archive written by cache_pretrained_weights.
+
+    The archive is memory-mapped and a tensor is only read from disk when its layer is built.
+    """
+
+    def __init__(self, archive_file):
+        with open(archive_file + '.index.json') as fp:
+            self._index = json.load(fp)
+        self._archive = np.memmap(archive_file, dtype=np.uint8, mode='r')
+
+    def __getitem__(self, name_scope):
+        entry = self._index[name_scope]
+        dtype = np.dtype(entry['dtype'])
+        size = int(np.prod(entry['shape'])) * dtype.itemsize
+        return self._archive[entry['offset']:entry['offset'] + size].view(dtype).reshape(entry['shape'])
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+def extract_pretrained_weights(checkpoint_file, archive_file=None):
+    """Makes the pretrained ResNet weights of checkpoint_file available through the global pretrained.
+
+    The weights are cached in archive_file (default: the checkpoint name with a .weights extension) on the
+    first call and memory-mapped from there afterwards.
+    """
+    global pretrained
+    if archive_file is None:
+        archive_file = os.path.splitext(checkpoint_file)[0] + '.weights'
+    if not os.path.exists(archive_file):
+        cache_pretrained_weights(checkpoint_file, archive_file)
+    pretrained = PretrainedWeights(archive_file)
+
+
+
+def update_progress(current, total, task):
+    bar_length = 50
+    text = ''
+    progress = float(current) / total
+    num_dots = int(round(bar_length * progress))
+    num_spaces = bar_length - num_dots
+    if current == total:
+        text = '\r\nDone.\r\n'
+    else:
+        text = ('\r[{}] {:.2f}% ' + task + ' {} of {}').format('.' * num_dots + ' ' * num_spaces, progress * 100,
+                                                               current, total)
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+def iter_questions(question_file, chunk_size=1 << 20):
+    """Yields the entries of the 'questions' list of a CLEVR questions file one by one.
+
+    The file is read in chunks of chunk_size characters and every entry is decoded on its own, so the whole
+    JSON document is never held in memory.
+    """
+    decoder = json.JSONDecoder()
+    separators = re.compile(r'[\s,]*')
+    with open(question_file) as fp:
+        buf = ''
+        # skip ahead to the opening bracket of the questions list
+        while True:
+            start = buf.find('"questions"')
+            if start >= 0 and buf.find('[', start) >= 0:
+                break
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                raise ValueError('No questions list in %s' % question_file)
+            buf += chunk
+        pos = buf.find('[', start) + 1
+
+        while True:
+            pos = separators.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                return
+            try:
+                entry, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the entry continues in the next chunk
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    raise ValueError('Truncated questions list in %s' % question_file)
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield entry
+            pos = end
+
+
+def make_example(tokens, label, image_file, dictionary):
+    ex = tf.train.SequenceExample()
+    ex.context.feature['length'].int64_list.value.append(len(tokens))
+    ex.context.feature['answer'].int64_list.value.append(label)
+    ex.context.feature['image_file'].bytes_list.value.append(image_file)
+    fl_tokens = ex.feature_lists.feature_list['words']
+    for token in tokens:
+        fl_tokens.feature.add().int64_list.value.append(dictionary[token.lower()])
+    return ex
+
+
+def write_shard(shard_file, entries, dictionary):
+    """Tokenizes a chunk of (question, label, image_file) entries and writes them to one TFRecord shard."""
+    writer = tf.python_io.TFRecordWriter(shard_file)
+    for question, label, image_file in entries:
+        tokens = re.split(r'\s+', re.sub(r'([;?])', r'', question))
+        writer.write(make_example(tokens, label, image_file, dictionary).SerializeToString())
+    writer.close()
+    return len(entries)
+
+
+def serialize_examples(question_file, dictionary, output_dir='data', shard_size=10000, num_workers=None):
+    """Writes the CLEVR questions as SequenceExamples to TFRecord shards of shard_size examples.
 
-    print('Generating tfrecord file from %s' % question_file)
-    data = json.load(open(question_file))
-
-    questions = []
-    answers = []
-    image_files = []
-    num_questions = len(data['questions'])
-    for i, entry in enumerate(data['questions']):
-        questions.append(re.split(r'\s+', re.sub(r'([;?])', r'', entry['question'])))
-        answers.append(entry['answer'].lower())
-        image_files.append(str.encode(entry['image_filename']))
-        if i % 100 == 0:
-            update_progress(i, num_questions, 'Parsing example')
-    update_progress(num_questions, num_questions, 'Parsing example')
-
-    print('Creating answer dictionary...', end=' ')
-    examples = [[dictionary[word.lower()] for word in q] for q in questions]
-    labels = []
+    The questions file is streamed, answer ids are assigned in order of first appearance as before, and
+    the shards are tokenized and written in parallel by a pool of num_workers processes (default: one per
+    CPU). The shard files and their sizes are listed in train_examples.index.json, see shard_files.
+    """
+    print('Generating tfrecord shards from %s' % question_file)
+    num_workers = num_workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(num_workers)
     answer_dict = {}
-    for a in answers:
-        if a not in answer_dict:
-            answer_dict[a] = len(answer_dict)
-        labels.append(answer_dict[a])
+
+    def chunks():
+        chunk = []
+        for entry in iter_questions(question_file):
+            answer = entry['answer'].lower()
+            if answer not in answer_dict:
+                answer_dict[answer] = len(answer_dict)
+            chunk.append((entry['question'], answer_dict[answer], str.encode(entry['image_filename'])))
+            if len(chunk) == shard_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    shards = []
+    pending = collections.deque()
+    num_examples = 0
+
+    def finish_shard():
+        shard_file, result = pending.popleft()
+        shards.append({'file': os.path.basename(shard_file), 'first_example': num_examples,
+                       'num_examples': result.get()})
+        sys.stdout.write('\rSerialized %d shards, %d examples' % (len(shards), num_examples + shards[-1]['num_examples']))
+        sys.stdout.flush()
+        return shards[-1]['num_examples']
+
+    for i, chunk in enumerate(chunks()):
+        shard_file = os.path.join(output_dir, 'train_examples-%05d.tfrecords' % i)
+        pending.append((shard_file, pool.apply_async(write_shard, (shard_file, chunk, dictionary))))
+        # only a few chunks are in flight at a time, so the parsed questions never pile up in memory
+        while len(pending) > 2 * num_workers:
+            num_examples += finish_shard()
+    while pending:
+        num_examples += finish_shard()
+    pool.close()
+    pool.join()
+    print('\r\nDone.')
 
     reverse_answer_dict = dict(zip(answer_dict.values(), answer_dict.keys()))
-    with open(os.path.join('data', 'answers.json'), 'w') as fp:
+    with open(os.path.join(output_dir, 'answers.json'), 'w') as fp:
         json.dump(reverse_answer_dict, fp)
 
-    assert len(labels) == len(examples), "Num examples does not match num labels"
-    print('Done.')
-
-    def make_example(question, answer, image_file):
-        ex = tf.train.SequenceExample()
-        ex.context.feature['length'].int64_list.value.append(len(question))
-        ex.context.feature['answer'].int64_list.value.append(answer_dict[answer])
-        ex.context.feature['image_file'].bytes_list.value.append(image_file)
-        fl_tokens = ex.feature_lists.feature_list['words']
-        for token in question:
-            fl_tokens.feature.add().int64_list.value.append(dictionary[token.lower()])
-        return ex
-
-    writer = tf.python_io.TFRecordWriter(os.path.join('data', 'train_examples.tfrecords'))
-    for i, (question, answer, image_file) in enumerate(zip(questions, answers, image_files)):
-        ex = make_example(question, answer, image_file)
-        writer.write(ex.SerializeToString())
-        if i % 100 == 0:
-            update_progress(i, num_questions, 'Serializing example')
-    update_progress(num_questions, num_questions, 'Serializing example')
-    writer.close()
+    with open(os.path.join(output_dir, 'train_examples.index.json'), 'w') as fp:
+        json.dump({'num_examples': num_examples, 'shards': shards}, fp)
+
 
+def shard_files(index_file):
+    """Returns the paths of the TFRecord shards listed in a shard index written by serialize_examples."""
+    with open(index_file) as fp:
+        index = json.load(fp)
+    return [os.path.join(os.path.dirname(index_file), shard['file']) for shard in index['shards']]
 
-def generate_batch(_inputs, batch_size):
-    with tf.name_scope('Batch_Generator'):
-        return tf.train.batch(_inputs, batch_size, num_threads=1, capacity=10768, dynamic_pad=True)
 
+def parse_example(serialized_example):
+    context_features = {
+        'length': tf.FixedLenFeature([], dtype=tf.int64),
+        'answer': tf.FixedLenFeature([], dtype=tf.int64),
+        'image_file': tf.FixedLenFeature([], dtype=tf.string)
+    }
+    sequence_features = {
+        'words': tf.FixedLenSequenceFeature([], dtype=tf.int64)
+    }
+    context_parsed, sequence_parsed = tf.parse_single_sequence_example(serialized_example, context_features,
+                                                                       sequence_features)
+    return context_parsed['length'], sequence_parsed['words'], context_parsed['answer'], context_parsed['image_file']
 
-def preprocess_example(_inputs):
-    length, question, answer, image_file = _inputs
 
+def preprocess_example(length, question, answer, image_file):
     with tf.name_scope('Extract_Image'):
         full_img_path = tf.string_join([tf.constant(img_dir, dtype=tf.string), image_file])
         img_data = tf.read_file(full_img_path)
         img = tf.image.decode_png(img_data, channels=3)
+        resized_img = tf.image.resize_images(img, [224, 224])
+    return length, question, answer, resized_img
+
 
-    # min_after_dequeue = 10000
-    # dtypes = [tf.int64, tf.int64, tf.int64, tf.float32]
-    # names = ['length', 'question', 'answer', 'image']
-    # example_queue = tf.RandomShuffleQueue(capacity=min_after_dequeue+3*256, min_after_dequeue=min_after_dequeue, dtypes=dtypes, names=names, name='preprocess_queue')
-    # enqueue_op = example_queue.enqueue({'length': length,
-    #                                     'question': question,
-    #                                     'answer': answer,
-    #                                     'image': tf.cast(img, tf.float32)})
-    # ex_qr = tf.train.QueueRunner(example_queue, [enqueue_op])
-    # tf.train.add_queue_runner(ex_qr)
-    # example = example_queue.dequeue()
-    # example['length'].set_shape(_inputs[0].get_shape())
-    # example['question'].set_shape(_inputs[1].get_shape())
-    # example['answer'].set_shape(_inputs[2].get_shape())
-    # example['image'].set_shape([224, 224, 3])
-    # return [example['length'], example['question'], example['answer'], example['image']]
-    return [length, question, answer, img]
-
-
-def shuffle_examples(_inputs):
-    with tf.variable_scope('shuffle'):
-        dtypes = list(map(lambda x: x.dtype, _inputs))
-        shapes = list(map(lambda x: x.get_shape(), _inputs))
-        shuffle_queue = tf.RandomShuffleQueue(capacity=5768, min_after_dequeue=5000, dtypes=dtypes)
-        enqueue_op = shuffle_queue.enqueue(_inputs)
-        qr = tf.train.QueueRunner(shuffle_queue, [enqueue_op] * 4)
-        tf.add_to_collection(tf.GraphKeys.QUEUE_RUNNERS, qr)
-        out = shuffle_queue.dequeue()
-        for tensor, shape in zip(out, shapes):
-            tensor.set_shape(shape)
-        return out
-
-
-def input_pipeline(input_files, batch_size):
+def input_pipeline(input_files, batch_size, decode_images=True, num_epochs=1000, num_readers=4,
+                   num_parallel_calls=8, shuffle_buffer=10000, prefetch_batches=2):
+    """Returns batches of (lengths, questions, answers, images) read from the TFRecord shards in input_files.
+
+    num_readers shards are read at once and interleaved, the examples are shuffled in a buffer of
+    shuffle_buffer serialized records, parsed and decoded by num_parallel_calls threads, padded to the
+    longest question of the batch and prefetch_batches batches are prepared ahead of the consumer.
+    With decode_images=False the image file names are returned instead of the images, to look up in the
+    feature store.
+    """
     with tf.name_scope('Input'):
-        filename_queue = tf.train.string_input_producer(input_files, num_epochs=1000)
-        reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
-        context_features = {
-            'length': tf.FixedLenFeature([], dtype=tf.int64),
-            'answer': tf.FixedLenFeature([], dtype=tf.int64),
-            'image_file': tf.FixedLenFeature([], dtype=tf.string)
-        }
-        sequence_features = {
-            'words': tf.FixedLenSequenceFeature([], dtype=tf.int64)
-        }
-        context_parsed, sequence_parsed = tf.parse_single_sequence_example(serialized_example, context_features,
-                                                                           sequence_features)
-        length = context_parsed['length']
-        question = sequence_parsed['words']
-        answer = context_parsed['answer']
-        image_file = context_parsed['image_file']
-
-        # min_after_dequeue = 10000
-        # names= ['length', 'question', 'answer', 'image_file']
-        # dtypes = [tf.int64, tf.int64, tf.int64, tf.string]
-        # shuffle = tf.RandomShuffleQueue(capacity=min_after_dequeue+3*batch_size, min_after_dequeue=min_after_dequeue, dtypes=dtypes, names=names)
-        # enqueue_op = shuffle.enqueue({'length': length,
-        #                               'question': question,
-        #                               'answer': answer,
-        #                               'image_file': image_file})
-        # shuffle_qr = tf.train.QueueRunner(shuffle, [enqueue_op])
-        # tf.train.add_queue_runner(shuffle_qr)
-        # example = shuffle.dequeue()
-        # example['length'].set_shape(length.get_shape())
-        # example['question'].set_shape(question.get_shape())
-        # example['answer'].set_shape(answer.get_shape())
-        # example['image_file'].set_shape(image_file.get_shape())
-
-        # length = example['length']
-        # question = example['question']
-        # answer = example['answer']
-        # image_file = example['image_file']
-
-        example = preprocess_example((length, question, answer, image_file))
-        #example = shuffle_examples(example)
-
-        lengths, questions, answers, images = generate_batch(example, batch_size=batch_size)
-        resized_images = tf.image.resize_images(images, [224, 224])
-
-        tf.summary.image('Original_Image', images)
-        #tf.summary.image('Resized_Image', resized_images)
-
-        return lengths, questions, answers, resized_images
-        # print(image_file)
-
-        # full_img_path = tf.string_join([tf.constant(img_dir, dtype=tf.string), image_file])
-
-        # img_data = tf.read_file(full_img_path)
-
-        # img = tf.image.decode_png(img_data, channels=3)
-
-        # img_batch = tf.reshape(img, [-1, 320, 480, 3])
-
-        # # tf.summary.image('Input_Picture', img_batch)
-
-        # resized_batch = tf.image.resize_images(img_batch, [224, 224])
-        # # tf.summary.image('Resized', resized_batch)
-
-        # return length, question, answer, resized_batch
+        files = tf.data.Dataset.from_tensor_slices(input_files).shuffle(len(input_files)).repeat(num_epochs)
+        try:
+            records = files.apply(tf.contrib.data.parallel_interleave(tf.data.TFRecordDataset,
+                                                                      cycle_length=num_readers, sloppy=True))
+        except AttributeError:
+            # tensorflow without contrib.data.parallel_interleave
+            records = files.interleave(tf.data.TFRecordDataset, cycle_length=num_readers)
+        examples = records.shuffle(shuffle_buffer).map(parse_example, num_parallel_calls=num_parallel_calls)
+
+        if decode_images:
+            examples = examples.map(preprocess_example, num_parallel_calls=num_parallel_calls)
+            image_shape = [224, 224, 3]
+        else:
+            image_shape = []
+        batches = examples.padded_batch(batch_size, padded_shapes=([], [None], [], image_shape))
+        lengths, questions, answers, images = batches.prefetch(prefetch_batches).make_one_shot_iterator().get_next()
+
+        if decode_images:
+            tf.summary.image('Resized_Image', images)
+
+        return lengths, questions, answers, images
 
 
 def conv_layer(_input, ksize, out_channels, stride):
@@ -259,7 +367,7 @@ def conv_layer(_input, ksize, out_channels, stride):
     return tf.nn.conv2d(_input, weights, strides=[1, stride, stride, 1], padding='SAME', name='conv')
 
 
-def batch_norm(_input):
+def batch_norm(_input, training=True):
     name_scope = tf.contrib.framework.get_name_scope()
     init_gamma = tf.constant_initializer(pretrained[os.path.join(name_scope, 'batch_normalization', 'gamma')])
     init_beta = tf.constant_initializer(pretrained[os.path.join(name_scope, 'batch_normalization', 'beta')])
@@ -267,7 +375,7 @@ def batch_norm(_input):
     init_var = tf.constant_initializer(pretrained[os.path.join(name_scope, 'batch_normalization', 'moving_variance')])
     return tf.layers.batch_normalization(_input, beta_initializer=init_beta, gamma_initializer=init_gamma,
                                          moving_mean_initializer=init_mean, moving_variance_initializer=init_var,
-                                         training=True, trainable=False)
+                                         training=training, trainable=False)
 
 
 def fc_layer(_input, out_channels):
@@ -281,52 +389,53 @@ def fc_layer(_input, out_channels):
     return tf.nn.xw_plus_b(_input, weights, biases)
 
 
-def block(_input, out_channels, stride):
+def block(_input, out_channels, stride, training=True):
     with tf.variable_scope('branch2'):
         with tf.variable_scope('a'):
             out = conv_layer(_input, ksize=1, out_channels=out_channels, stride=stride)
-            out = batch_norm(out)
+            out = batch_norm(out, training)
             out = tf.nn.relu(out, name='relu')
 
         with tf.variable_scope('b'):
             out = conv_layer(out, ksize=3, out_channels=out_channels, stride=1)
-            out = batch_norm(out)
+            out = batch_norm(out, training)
             out = tf.nn.relu(out, name='relu')
 
         with tf.variable_scope('c'):
             out = conv_layer(out, ksize=1, out_channels=4 * out_channels, stride=1)
-            out = batch_norm(out)
+            out = batch_norm(out, training)
 
     with tf.variable_scope('branch1'):
         if stride != 1 or tf.contrib.framework.get_name_scope() == 'res2/block1/branch1':
             shortcut = conv_layer(_input, ksize=1, out_channels=4 * out_channels, stride=stride)
-            shortcut = batch_norm(shortcut)
+            shortcut = batch_norm(shortcut, training)
         else:
             shortcut = _input
 
     return tf.nn.relu(shortcut + out, name='relu')
 
 
-def res_layer(_input, num_blocks, out_channels, stride):
+def res_layer(_input, num_blocks, out_channels, stride, training=True):
     out = _input
     for i in range(num_blocks):
         with tf.variable_scope('block%d' % (i + 1)):
             stride = stride if i == 0 else 1
-            out = block(out, out_channels, stride)
+            out = block(out, out_channels, stride, training)
     return out
 
 
-def res_net(_input):
+def res_net(_input, training=True):
+  # training=False normalizes with the pretrained moving mean/variance instead of the batch statistics
   with tf.variable_scope('res1'):
     out = conv_layer(_input, ksize=7, out_channels=64, stride=2)
-    out = batch_norm(out)
+    out = batch_norm(out, training)
     out = tf.nn.max_pool(out, ksize=[1, 3, 3, 1], strides=[1, 2, 2, 1], padding='SAME')
 
   with tf.variable_scope('res2'):
-    out = res_layer(out, num_blocks=3, out_channels=64, stride=1)
+    out = res_layer(out, num_blocks=3, out_channels=64, stride=1, training=training)
 
   with tf.variable_scope('res3'):
-    out = res_layer(out, num_blocks=4, out_channels=128, stride=2)
+    out = res_layer(out, num_blocks=4, out_channels=128, stride=2, training=training)
 
  # with tf.variable_scope('res4'):
    # out = res_layer(out, num_blocks=23, out_channels=256, stride=2)
@@ -350,12 +459,70 @@ def res_net(_input):
   return out
 
 
+def extract_features(image_dir, output_file, batch_size=32, dtype=np.float32):
+    """Runs the frozen res_net once over every png in image_dir and stores the feature maps.
+
+    The features go to a memory-mapped .npy array of shape [num_images, 28, 28, 512], one row per image in
+    sorted file name order, and output_file + '.index.json' maps each image file name to its row.
+    batch_norm runs in inference mode with the pretrained moving mean/variance, like the live res_net path in
+    main, so every cached feature map depends only on its image and equals what main would compute for it.
+    dtype=np.float16 halves the store (about 56GB instead of 112GB for the 70k CLEVR training images), at the
+    cost of rounding the features the model is trained on.
+    """
+    image_files = sorted(f for f in os.listdir(image_dir) if f.endswith('.png'))
+    extract_pretrained_weights('data/resnet_v1_101.ckpt')
+
+    with tf.Graph().as_default():
+        filenames = tf.placeholder(tf.string, [None])
+
+        def load_image(filename):
+            img = tf.image.decode_png(tf.read_file(tf.string_join([image_dir, filename])), channels=3)
+            return tf.image.resize_images(img, [224, 224])
+
+        images = tf.map_fn(load_image, filenames, dtype=tf.float32)
+        features = res_net(images, training=False)
+
+        store = np.lib.format.open_memmap(output_file, mode='w+', dtype=dtype,
+                                          shape=tuple([len(image_files)] + features.get_shape().as_list()[1:]))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for start in range(0, len(image_files), batch_size):
+                batch = image_files[start:start + batch_size]
+                store[start:start + len(batch)] = sess.run(features, feed_dict={filenames: batch})
+                update_progress(start, len(image_files), 'Extracting features')
+            update_progress(len(image_files), len(image_files), 'Extracting features')
+        store.flush()
+
+    with open(output_file + '.index.json', 'w') as fp:
+        json.dump(dict((f, i) for i, f in enumerate(image_files)), fp)
+
+
+def load_feature_store(feature_file):
+    """Memory-maps the features written by extract_features, returns them with the file name -> row index."""
+    with open(feature_file + '.index.json') as fp:
+        index = json.load(fp)
+    return np.load(feature_file, mmap_mode='r'), index
+
+
+def lookup_features(image_files, features, index):
+    """Reads the cached res_net output for a batch of image file names, in place of decoding and res_net."""
+    def gather(files):
+        rows = [index[f.decode()] for f in files]
+        return np.asarray(features[rows], dtype=np.float32)
+
+    with tf.name_scope('Feature_Lookup'):
+        out = tf.py_func(gather, [image_files], tf.float32, stateful=False)
+        out.set_shape([None] + list(features.shape[1:]))
+    return out
+
+
 def soft_attention(image, query):
     print(query)
     print('qyery')
     with tf.variable_scope("soft_attention"):
 
-        i = tf.reshape(image, [32, 28*28, 512], name=None)
+        # the batch size is taken from the image at run time, so any batch size works
+        i = tf.reshape(image, [tf.shape(image)[0], 28*28, 512], name=None)
 
         tf.summary.image("image_input", image[:, :, :, :3], max_outputs=1)
 
@@ -367,23 +534,16 @@ def soft_attention(image, query):
             weights_i = tf.get_variable('weights_i', [512, 512],
                                       initializer=tf.random_normal_initializer(),
                                       trainable=True)
-            a = tf.reshape(i, [-1, 512])
-            h2 = tf.matmul(a, weights_i)
-            h2 = tf.reshape(h2, [-1, 28*28, 512])
-
-            h2 = tf.transpose(h2, [1, 0, 2])
-            h = tf.add(h1, h2)
-            h = tf.transpose(h, [1, 0, 2])
+            h2 = tf.tensordot(i, weights_i, [[2], [0]])
+            h = h2 + tf.expand_dims(h1, 1)
 
             ha = tf.tanh(h)
 
         with tf.variable_scope("pi"):
             weights = tf.get_variable('weights', [512, 1], initializer=tf.random_normal_initializer(), trainable=True)
             biases = tf.get_variable('biases', [784], initializer=tf.zeros_initializer())
-            ha = tf.reshape(ha, [-1, 512])
-            pi = tf.matmul(ha, weights)
+            pi = tf.squeeze(tf.tensordot(ha, weights, [[2], [0]]), axis=2)
             print("pi", pi)
-            pi = tf.reshape(pi, [32, 784])
             pi = tf.add(pi, biases)
             pi = tf.nn.softmax(pi)
             # pi = tf.nn.xw_plus_b(ha, weights_attention_p, biases_attention_p)
@@ -391,17 +551,13 @@ def soft_attention(image, query):
             # pi = tf.divide(tf.transpose(pi), tf.reduce_max(pi, -1))
             # pi = tf.transpose(pi)
 
-        pi = tf.reshape(pi, [32, 28, 28], name=None)
-
-        pii = tf.reshape(pi, [32, 28, 28, 1], name=None)
+        pii = tf.reshape(pi, [-1, 28, 28, 1], name=None)
         tf.summary.image("atention_mask", pii, max_outputs=1)
-        image = tf.transpose(image, [3, 0, 1, 2])
-        output_image = tf.multiply(pi, image)
-        image = tf.transpose(image, [1, 2, 3, 0])
-        output_image = tf.transpose(output_image, [1, 2, 3, 0])
+        output_image = tf.multiply(pii, image)
         tf.summary.image("image_output", output_image[:, :, :, :3], max_outputs=1)
 
-        vi = tf.reduce_sum(tf.reshape(output_image, [32, 784, 512]), axis=1)
+        # attention weighted sum over the grid, one (1 x 784) x (784 x 512) product per example
+        vi = tf.squeeze(tf.matmul(tf.expand_dims(pi, 1), i), axis=1)
         u = vi + query
 
     return u, pii
@@ -492,7 +648,7 @@ def test_imagenet(image_dir):
         coord.request_stop()
         coord.join(threads)
 
-def main(embedding):
+def main(embedding, feature_file=None):
     # img_files = tf.gfile.ListDirectory(img_dir)
     # print(img_files)
     # img_files = [os.path.join(img_dir, filename) for filename in img_files]
@@ -505,14 +661,21 @@ def main(embedding):
     with open(os.path.join('data', 'id_to_human.json')) as file:
         id_to_label = json.load(file)
 
-    extract_pretrained_weights('data/resnet_v1_101.ckpt')
-    example_batch = input_pipeline(['data/train_examples.tfrecords'], batch_size=1)
-    lengths, questions, answers, images = example_batch
-    print('questions')
-    print(questions)
-
-    # apply resnet  until resnet4
-    logits = res_net(images)
+    if feature_file is None:
+        extract_pretrained_weights('data/resnet_v1_101.ckpt')
+        example_batch = input_pipeline(shard_files(example_index), batch_size=batch_size)
+        lengths, questions, answers, images = example_batch
+        print('questions')
+        print(questions)
+
+        # apply resnet  until resnet4, frozen: inference-mode batch_norm, so no moving statistics are updated
+        logits = res_net(images, training=False)
+    else:
+        # res_net is frozen, so its output was computed once per image by extract_features (with the same
+        # inference-mode batch_norm as above)
+        example_batch = input_pipeline(shard_files(example_index), batch_size=batch_size, decode_images=False)
+        lengths, questions, answers, image_files = example_batch
+        logits = lookup_features(image_files, *load_feature_store(feature_file))
     print(logits)
     print('1')
 
@@ -533,26 +696,25 @@ def main(embedding):
     print(logits)
     query, pii = soft_attention(logits, last_hidden)
 
-    # Apply upscaled attention mask to input image for visualization
+    # Apply upscaled attention mask to input image for visualization (needs the decoded images)
     # This is just to help with visualization, it is not equivalent to reversed convolutions kind of thing (TODO?)
-    sa_mask = pii * 255
-    upscaled_sa_mask = tf.image.resize_area(sa_mask, [224, 224])
+    if feature_file is None:
+        sa_mask = pii * 255
+        upscaled_sa_mask = tf.image.resize_area(sa_mask, [224, 224])
 
-    images_graysacale = tf.image.rgb_to_grayscale(images)
-    images_graysacale = tf.image.grayscale_to_rgb(images_graysacale)
-    images_graysacale = (images_graysacale // 2) + 127
+        images_graysacale = tf.image.rgb_to_grayscale(images)
+        images_graysacale = tf.image.grayscale_to_rgb(images_graysacale)
+        images_graysacale = (images_graysacale // 2) + 127
 
-    image_r, image_g, image_b = tf.split(images_graysacale, num_or_size_splits=3, axis=3)
-    image_g = tf.subtract(image_g, upscaled_sa_mask)
-    image_b = tf.subtract(image_b, upscaled_sa_mask)
+        image_r, image_g, image_b = tf.split(images_graysacale, num_or_size_splits=3, axis=3)
+        image_g = tf.subtract(image_g, upscaled_sa_mask)
+        image_b = tf.subtract(image_b, upscaled_sa_mask)
 
-    image_masked = tf.stack([image_r, image_g, image_b])
-    image_masked = tf.reshape(image_masked, [3, 32, 224, 224])
-    image_masked = tf.transpose(image_masked, [1, 2, 3, 0])
+        image_masked = tf.concat([image_r, image_g, image_b], axis=3)
 
-    tf.summary.image("masked_input", image_masked, max_outputs=3)
+        tf.summary.image("masked_input", image_masked, max_outputs=3)
 
-    logits = tf.reshape(logits, [32, -1])
+    logits = tf.reshape(logits, [tf.shape(logits)[0], -1])
 
     with tf.variable_scope('answer'):
         weights = tf.get_variable('weights', [512, 28], initializer=tf.random_normal_initializer(), trainable=True)
@@ -578,9 +740,9 @@ def main(embedding):
         question_table = index_to_string_table_from_file(vocabulary_file='data/vocabulary.txt', name='Question_Table')
         answer_table = index_to_string_table_from_file(vocabulary_file='data/answers.txt', name='Answer_Table')
         question_strings = tf.expand_dims(
-            tf.reduce_join(question_table.lookup(tf.slice(questions, [0, 0], [31, -1])), axis=1, separator=' '), axis=1)
-        answer_strings = tf.expand_dims(answer_table.lookup(tf.slice(answers, [0], [31])), axis=1)
-        prediction_strings = tf.expand_dims(answer_table.lookup(tf.slice(predictions, [0], [31])), axis=1)
+            tf.reduce_join(question_table.lookup(questions[:31]), axis=1, separator=' '), axis=1)
+        answer_strings = tf.expand_dims(answer_table.lookup(answers[:31]), axis=1)
+        prediction_strings = tf.expand_dims(answer_table.lookup(predictions[:31]), axis=1)
         labels = tf.constant(['Question', 'Answer', 'Prediction'], shape=[1, 3])
         qa_table = tf.concat([question_strings, answer_strings, prediction_strings], axis=1)
         qa_table = tf.concat([labels, qa_table], axis=0)
@@ -598,9 +760,6 @@ def main(embedding):
         summary_writer = tf.summary.FileWriter('logs/' + date_string, graph=sess.graph)
         summary_op = tf.summary.merge_all()
 
-        coord = tf.train.Coordinator()
-        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
-
         for i in range(100):
             if i % 10 == 0:
                 _, summary, acc = sess.run([train_op, summary_op, accuracy])
@@ -612,13 +771,13 @@ def main(embedding):
             if i % 5000 == 0:
                 saver.save(sess, 'logs/' + date_string + '/model.ckpt', global_step=i)
 
-        coord.request_stop()
-        coord.join(threads)
-
 
 if __name__ == '__main__':
-    embedding, dictionary, reverse_dictionary = build_embeddings('data/embeddings.json', 'data/vocab.tsv')
+    if not os.path.exists(embedding_store):
+        convert_embeddings('data/embeddings.json', 'data/vocab.tsv', embedding_store)
+    embedding, dictionary, reverse_dictionary = load_embeddings(embedding_store)
     # serialize_examples(question_dir, dictionary)
-    main(embedding)
+    # extract_features(img_dir, feature_file)
+    main(embedding, feature_file if os.path.exists(feature_file) else None)
     # test_imagenet('/Users/larrychen/Downloads/images')
     # run_lstm(embedding)
@@ -1,11 +1,15 @@
 # takes data saved by DRAW model and generates animations
-# example usage: python plot_data.py noattn /tmp/draw/draw_data.npy
+# example usage: python plot_data.py noattn /tmp/draw/draw_data
 
 import matplotlib
+import os
 import sys
 import numpy as np
+import draw_store
 
 interactive=False # set to False if you want to write images to file
+write_strip=True # also write all time steps side by side in a single png
+write_gif=True # also write an animated gif of the time steps
 
 if not interactive:
 	matplotlib.use('Agg') # Force matplotlib to not use any Xwindows backend.
@@ -14,48 +18,77 @@ import matplotlib.pyplot as plt
 
 def xrecons_grid(X,B,A):
 	"""
-	plots canvas for single time step
-	X is x_recons, (batch_size x img_size)
+	plots canvas for single time step, or for every time step at once
+	X is x_recons, (batch_size x img_size) or (T x batch_size x img_size)
 	assumes features = BxA images
 	batch is assumed to be a square number
+	returns the (H x W) grid, or the (T x H x W) stack of grids
 	"""
 	padsize=1
 	padval=.5
-	ph=B+2*padsize
-	pw=A+2*padsize
-	batch_size=X.shape[0]
+	X=np.asarray(X)
+	single=X.ndim==2
+	if single:
+		X=X[np.newaxis]
+	T,batch_size=X.shape[:2]
 	N=int(np.sqrt(batch_size))
-	X=X.reshape((N,N,B,A))
-	img=np.ones((N*ph,N*pw))*padval
-	for i in range(N):
-		for j in range(N):
-			startr=i*ph+padsize
-			endr=startr+B
-			startc=j*pw+padsize
-			endc=startc+A
-			img[startr:endr,startc:endc]=X[i,j,:,:]
-	return img
+	X=X.reshape((T,N,N,B,A))
+	# pad every tile, then interleave tile rows with pixel rows (and columns with columns) in one reshape
+	X=np.pad(X,((0,0),(0,0),(0,0),(padsize,padsize),(padsize,padsize)),'constant',constant_values=padval)
+	img=X.transpose((0,1,3,2,4)).reshape((T,N*(B+2*padsize),N*(A+2*padsize)))
+	return img[0] if single else img
+
+def canvas_frames(C,B,A):
+	"""
+	yields the grid of x_recons=sigmoid(canvas) for every time step of C (T x batch_size x img_size)
+	C can be a memmap, only one time step is read and transformed at a time
+	"""
+	for t in range(C.shape[0]):
+		yield xrecons_grid(1.0/(1.0+np.exp(-C[t])),B,A)
+
+def write_frames(imgs,prefix):
+	"""
+	writes a sequence of (H x W) grids straight from numpy, without a matplotlib figure per frame:
+	prefix_<t>.png for every frame, plus prefix_strip.png and prefix.gif if enabled
+	imgs can be a generator, frames are written as they come and only kept as uint8 for the strip and gif
+	pixel values are expected in [0,1]
+	"""
+	frames=[]
+	for t,img in enumerate(imgs):
+		imgname='%s_%d.png' % (prefix,t)
+		plt.imsave(imgname,img,cmap=plt.cm.gray,vmin=0,vmax=1)
+		print(imgname)
+		if write_strip or write_gif:
+			frames.append(np.uint8(np.clip(img,0,1)*255))
+	if write_strip:
+		imgname='%s_strip.png' % prefix
+		plt.imsave(imgname,np.concatenate(frames,axis=1),cmap=plt.cm.gray,vmin=0,vmax=255)
+		print(imgname)
+	if write_gif:
+		from PIL import Image # installed along with matplotlib
+		frames=[Image.fromarray(frame) for frame in frames]
+		imgname='%s.gif' % prefix
+		frames[0].save(imgname,save_all=True,append_images=frames[1:],duration=100,loop=0)
+		print(imgname)
 
 if __name__ == '__main__':
 	#MNIST=sys.argv[1]
 	#draw_data=sys.argv[2]
-	[C,Lxs,Lzs]=np.load('draw_data.npy')
+	if os.path.isdir('draw_data'):
+		[C,Lxs,Lzs]=draw_store.load('draw_data') # memory-mapped
+	else:
+		[C,Lxs,Lzs]=np.load('draw_data.npy',allow_pickle=True) # older runs saved one pickled object array
 	T,batch_size,img_size=C.shape
-	X=1.0/(1.0+np.exp(-C)) # x_recons=sigmoid(canvas)
 	B=A=int(np.sqrt(img_size))
+	imgs=canvas_frames(C,B,A) # one H x W grid per time step
 	if interactive:
 		f,arr=plt.subplots(1,T)
-	for t in range(T):
-		img=xrecons_grid(X[t,:,:],B,A)
-		if interactive:
+		for t,img in enumerate(imgs):
 			arr[t].matshow(img,cmap=plt.cm.gray)
 			arr[t].set_xticks([])
 			arr[t].set_yticks([])
-		else:
-			plt.matshow(img,cmap=plt.cm.gray)
-			imgname='%s_%d.png' % ('MNIST',t) # you can merge using imagemagick, i.e. convert -delay 10 -loop 0 *.png mnist.gif
-			plt.savefig(imgname)
-			print(imgname)
+	else:
+		write_frames(imgs,'MNIST') # to merge by hand, i.e. convert -delay 10 -loop 0 *.png mnist.gif
 	f=plt.figure()
 	plt.plot(Lxs,label='Reconstruction Loss Lx')
 	plt.plot(Lzs,label='Latent Loss Lz')
@@ -65,4 +98,3 @@ if __name__ == '__main__':
 		plt.show()
 	else:
 		plt.savefig('%s_loss.png' % ('MNIST'))
-
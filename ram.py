@@ -1,9 +1,13 @@
 import tensorflow as tf
+from tensorflow.python.ops import gen_nn_ops
 import tf_mnist_loader
+import frozen_graph
 import matplotlib.pyplot as plt
 import numpy as np
 import time
-import random
+import threading
+import json
+import numbers
 import sys
 import os
 
@@ -12,7 +16,17 @@ try:
 except NameError:
     xrange = range
 
-dataset = tf_mnist_loader.read_data_sets("mnist_data")
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+dataset = tf_mnist_loader.read_data_sets("mnist_data", cache=True)
 save_dir = "chckPts/"
 save_prefix = "save"
 summaryFolderName = "summary/"
@@ -33,11 +47,19 @@ else:
     print ("Testing... image files will not be saved.")
 
 
-start_step = 0
-#load_path = None
-load_path = save_dir + save_prefix + str(start_step) + ".ckpt"
+resume = 1                  # continue training from the newest checkpoint in save_dir, if there is one
+saveFreq = 5000             # steps between checkpoints (written in the background)
+keepCheckpoints = 5         # number of newest checkpoints kept in save_dir
 # to enable visualization, set draw to True
 eval_only = False
+benchmarkFeeding = 0        # time serial vs prefetched batch preparation, then exit
+serve = 0                   # classify requests from stdin with the latest checkpoint, forward-only graph
+exportGraph = 0             # freeze the latest checkpoint into a forward-only graph file (exportPath), then exit
+exportPath = "ram_frozen.pb"
+earlyExit = 0               # score the latest checkpoint with early exit at earlyExitThresholds, then exit
+earlyExitThresholds = [0.5, 0.8, 0.9, 0.95, 0.99, 1.0]
+quantizeWeights = 0         # int8 glimpse/core weights, per-channel scales; alone: compare with float, then exit
+forward_only = serve or exportGraph or earlyExit or quantizeWeights
 draw = 0
 animate = 0
 
@@ -98,6 +120,20 @@ n_classes = 10              # card(Y)
 
 # training parameters
 max_iters = 1000000
+eval_batch_size = 1000      # the graph takes any batch size, so evaluate in big batches
+logFreq = 20                # steps between logs, summaries and drawing
+prefetchBatches = 4         # batches prepared ahead by a background thread (0 = prepare in the training loop)
+evalSeed = 1234             # seeds the translation of the test set, so every evaluation scores the same images
+evalSamples = 1             # glimpse trajectories per test image, their class probabilities are averaged
+evalSampling = False        # follow the mean locations, so evaluations are reproducible; True: sampled (unseeded)
+
+# serving
+servePort = 0               # also take requests on this localhost TCP port (0 = stdin only)
+serveBatchSize = 64         # max requests per micro-batch
+serveMaxLatency = 0.005     # seconds a request waits for others to join its micro-batch
+serveSamples = 1            # glimpse trajectories per request (see evalSamples)
+serveSampling = False       # greedy: follow the mean locations
+serveReportFreq = 1000      # requests between latency reports
 SMALL_NUM = 1e-10
 
 # resource prellocation
@@ -105,6 +141,9 @@ mean_locs = []              # expectation of locations
 sampled_locs = []           # sampled locations ~N(mean_locs[.], loc_sd)
 baselines = []              # baseline, the value prediction
 glimpse_images = []         # to show in window
+eval_inputs = None          # the test set as model inputs, built once by get_eval_inputs
+serve_queue = queue.Queue() # (request line, arrival time, reply function) of the requests waiting to be served
+int8_weights = {}           # weight name -> (int8 weight, per-channel scales), see int8_weight
 
 
 # set the weights to be small random values, with truncated normal distribution
@@ -115,60 +154,49 @@ def weight_variable(shape, myname, train):
 # get local glimpses
 def glimpseSensor(img, normLoc):
     loc = tf.round(((normLoc + 1) / 2.0) * img_size)  # normLoc coordinates are between -1 and 1
-    loc = tf.cast(loc, tf.int32)
-
-    img = tf.reshape(img, (batch_size, img_size, img_size, channels))
-
-    # process each image individually
-    zooms = []
-    for k in xrange(batch_size):
-        imgZooms = []
-        one_img = img[k,:,:,:]
-        max_radius = minRadius * (2 ** (depth - 1))
-        offset = 2 * max_radius
-
-        # pad image with zeros
-        one_img = tf.image.pad_to_bounding_box(one_img, offset, offset, \
-                                               max_radius * 4 + img_size, max_radius * 4 + img_size)
-
-        for i in xrange(depth):
-            r = int(minRadius * (2 ** (i)))
-
-            d_raw = 2 * r
-            d = tf.constant(d_raw, shape=[1])
-            d = tf.tile(d, [2])
-            loc_k = loc[k,:]
-            adjusted_loc = offset + loc_k - r
-            one_img2 = tf.reshape(one_img, (one_img.get_shape()[0].value, one_img.get_shape()[1].value))
 
-            # crop image to (d x d)
-            zoom = tf.slice(one_img2, adjusted_loc, d)
+    max_radius = minRadius * (2 ** (depth - 1))
+    offset = 2 * max_radius
+    padded_size = max_radius * 4 + img_size
 
-            # resize cropped image to (sensorBandwidth x sensorBandwidth)
-            zoom = tf.image.resize_bilinear(tf.reshape(zoom, (1, d_raw, d_raw, 1)), (sensorBandwidth, sensorBandwidth))
-            zoom = tf.reshape(zoom, (sensorBandwidth, sensorBandwidth))
-            imgZooms.append(zoom)
+    # pad the whole batch with zeros once, so that every crop stays inside the image
+    img = tf.reshape(img, (-1, img_size, img_size, channels))
+    img = tf.image.pad_to_bounding_box(img, offset, offset, padded_size, padded_size)
+    n_examples = tf.shape(normLoc)[0]
 
-        zooms.append(tf.stack(imgZooms))
+    # one (d x d) box per example and zoom, d = 2 * minRadius * 2**<depth_level>
+    radii = tf.constant([minRadius * (2 ** i) for i in xrange(depth)], dtype=tf.float32)
+    top_left = offset + tf.expand_dims(loc, 1) - tf.reshape(radii, (1, depth, 1))
+    # crop_and_resize samples both box corners, resize_bilinear stops one output pixel short of the far edge
+    extent = tf.reshape(2 * radii * (sensorBandwidth - 1) / sensorBandwidth, (1, depth, 1))
+    boxes = tf.concat(axis=2, values=[top_left, top_left + extent]) / (padded_size - 1)
+    boxes = tf.reshape(boxes, (-1, 4))
+    box_ind = tf.reshape(tf.tile(tf.expand_dims(tf.range(n_examples), 1), [1, depth]), [-1])
 
-    zooms = tf.stack(zooms)
-
-    glimpse_images.append(zooms)
+    # crop every zoom of every example and resize it to (sensorBandwidth x sensorBandwidth) in a single op
+    zooms = tf.image.crop_and_resize(img, boxes, box_ind, (sensorBandwidth, sensorBandwidth))
+    zooms = tf.reshape(zooms, (-1, depth, sensorBandwidth, sensorBandwidth))
 
     return zooms
 
 # implements the input network
 def get_glimpse(loc):
     # get input using the previous location
-    glimpse_input = glimpseSensor(inputs_placeholder, loc)
-    glimpse_input = tf.reshape(glimpse_input, (batch_size, totalSensorBandwidth))
+    glimpse_input = glimpseSensor(model_inputs, loc)
+    glimpse_images.append(glimpse_input)
+    return glimpse_network(glimpse_input, loc)
+
+
+def glimpse_network(glimpse_input, loc):
+    glimpse_input = tf.reshape(glimpse_input, (-1, totalSensorBandwidth))
 
     # the hidden units that process location & the input
-    act_glimpse_hidden = tf.nn.relu(tf.matmul(glimpse_input, Wg_g_h) + Bg_g_h)
+    act_glimpse_hidden = tf.nn.relu(glimpse_matmul(glimpse_input, Wg_g_h) + Bg_g_h)
     act_loc_hidden = tf.nn.relu(tf.matmul(loc, Wg_l_h) + Bg_l_h)
 
     # the hidden units that integrates the location & the glimpses
-    glimpseFeature1 = tf.nn.relu(tf.matmul(act_glimpse_hidden, Wg_hg_gf1) + tf.matmul(act_loc_hidden, Wg_hl_gf1) + Bg_hlhg_gf1)
+    glimpseFeature1 = tf.nn.relu(glimpse_matmul(act_glimpse_hidden, Wg_hg_gf1) +
+                                 glimpse_matmul(act_loc_hidden, Wg_hl_gf1) + Bg_hlhg_gf1)
     # return g
     # glimpseFeature2 = tf.matmul(glimpseFeature1, Wg_gf1_gf2) + Bg_gf1_gf2
     return glimpseFeature1
@@ -189,9 +217,11 @@ def get_next_input(output):
     mean_loc = tf.stop_gradient(mean_loc)
     mean_locs.append(mean_loc)
 
-    # add noise
+    # add noise, unless the trajectory is deterministic
     # sample_loc = tf.tanh(mean_loc + tf.random_normal(mean_loc.get_shape(), 0, loc_sd))
-    sample_loc = tf.maximum(-1.0, tf.minimum(1.0, mean_loc + tf.random_normal(mean_loc.get_shape(), 0, loc_sd)))
+    sample_loc = tf.cond(loc_sampling,
+                         lambda: tf.maximum(-1.0, tf.minimum(1.0, mean_loc + tf.random_normal(tf.shape(mean_loc), 0, loc_sd))),
+                         lambda: tf.maximum(-1.0, tf.minimum(1.0, mean_loc)))
 
     # don't propagate throught the locations
     sample_loc = tf.stop_gradient(sample_loc)
@@ -200,21 +230,151 @@ def get_next_input(output):
     return get_glimpse(sample_loc)
 
 
+def int8_matmul_available():
+    # the int8 CPU kernel of QuantizedMatMulWithBiasAndDequantize is only built into TensorFlow with oneDNN (MKL)
+    try:
+        from tensorflow.python.framework import kernels
+    except ImportError:
+        return False
+    return len(kernels.get_registered_kernels_for_op('QuantizedMatMulWithBiasAndDequantize').kernel) > 0
+
+
+def int8_weight(shape, name):
+    '''
+    A glimpse/core network weight held as int8, with one float scale per output channel (column), used by int8_matmul
+    quantize_weights fills it from a float checkpoint.
+    :return: name, the key of the weight in int8_weights
+    '''
+    if name not in int8_weights:
+        if not int8_matmul_available():
+            raise RuntimeError('quantizeWeights needs the int8 matmul kernel of TensorFlow built with oneDNN')
+        # local variables, so that the saver neither writes them nor expects them in the float checkpoints,
+        # named after the float weight at the top level (e.g. coreNetwork/w_int8), whatever scope it is first used in
+        with tf.get_default_graph().name_scope(None):
+            W_int8 = tf.Variable(tf.zeros(shape, dtype=tf.int8), trainable=False, name=name + "_int8",
+                                 collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            W_scale = tf.Variable(tf.ones(shape[1:]), trainable=False, name=name + "_scale",
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        int8_weights[name] = (W_int8, W_scale)
+    return name
+
+
+def int8_matmul(x, name):
+    '''
+    x times the int8 weight name, computed in integers: x is quantized to 8 bits over [0, max(x)] (one range for the
+    whole batch) and multiplied by the int8 weight into int32, converted to float, then the per-column scales are
+    applied to the product, since x * (W_int8 * scale) == (x * W_int8) * scale. x must not be negative (all the inputs
+    of the quantized weights are pixels or ReLU outputs).
+    '''
+    W_int8, W_scale = int8_weights[name]
+    x_quint8, x_min, x_max = tf.quantize(x, 0.0, tf.maximum(tf.reduce_max(x), SMALL_NUM), tf.quint8)
+    # the frozen output range only applies to a quantized output
+    product = gen_nn_ops.quantized_mat_mul_with_bias_and_dequantize(
+        x_quint8, tf.bitcast(W_int8, tf.qint8), tf.zeros(W_scale.get_shape()), x_min, x_max, -127.0, 127.0,
+        0.0, 0.0, Toutput=tf.float32)
+    return product * W_scale
+
+
+def glimpse_weight(shape, myname):
+    # the weights of the glimpse and core networks, int8 with quantizeWeights (only in the forward-only graph)
+    if quantizeWeights:
+        return int8_weight(shape, myname)
+    return weight_variable(shape, myname, True)
+
+
+def glimpse_matmul(x, W):
+    # x times a weight made by glimpse_weight
+    if quantizeWeights:
+        return int8_matmul(x, W)
+    return tf.matmul(x, W)
+
+
+def quantize_weights(checkpoint):
+    '''
+    Post-training quantization of the float weights of checkpoint into int8_weights: symmetric, one scale per output
+    channel (column), scale = max|w| / 127
+    '''
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    for name, (W_int8, W_scale) in int8_weights.items():
+        w = reader.get_tensor(name)
+        scale = np.abs(w).max(0) / 127.0
+        scale[scale == 0] = 1.0
+        W_int8.load(np.round(w / scale).astype(np.int8), sess)
+        W_scale.load(scale.astype(np.float32), sess)
+
+
+def compare_quantized(n_rounds=3):
+    '''
+    Score the latest checkpoint with the int8 glimpse/core weights and with the original float weights
+    The float model is the graph saved with the checkpoint, run in a session of its own, so that neither graph has to
+    carry the weights or the ops of the other. The two are scored alternately n_rounds times, the latencies reported
+    are the best median batch latency of each.
+    '''
+    checkpoint = restore_latest_checkpoint()
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    float_bytes = sum(reader.get_tensor(name).nbytes for name in int8_weights)
+    int8_bytes = sum(W_int8.get_shape().num_elements() + 4 * W_scale.get_shape().num_elements()
+                     for W_int8, W_scale in int8_weights.values())
+    print('%d quantized weight matrices: %d bytes float32, %d bytes int8 + scales'
+          % (len(int8_weights), float_bytes, int8_bytes))
+
+    float_graph = tf.Graph()
+    with float_graph.as_default():
+        tf.train.import_meta_graph(checkpoint + '.meta', clear_devices=True)
+        float_saver = tf.train.Saver()
+    float_sess = tf.Session(graph=float_graph)
+    float_saver.restore(float_sess, checkpoint)
+
+    def float_predict(images):
+        return float_sess.run('predicted_labels:0', feed_dict={'images:0': images, 'mc_samples:0': evalSamples,
+                                                               'loc_sampling:0': evalSampling})
+
+    float_latencies, int8_latencies = [], []
+    for i in xrange(n_rounds):
+        print('FLOAT WEIGHTS')
+        float_accuracy, latency = evaluate(float_predict)
+        float_latencies.append(latency)
+        print('INT8 WEIGHTS')
+        int8_accuracy, latency = evaluate()
+        int8_latencies.append(latency)
+    float_sess.close()
+    float_latency, int8_latency = min(float_latencies), min(int8_latencies)
+    print('ACCURACY CHANGE: %+.4f' % (int8_accuracy - float_accuracy))
+    print('BATCH LATENCY p50: %.1f ms float, %.1f ms int8 (%.2fx)'
+          % (1000 * float_latency, 1000 * int8_latency, float_latency / int8_latency))
+
+
 def affineTransform(x,output_dim):
     """
     affine transformation Wx+b
     assumes x.shape = (batch_size, num_features)
     """
-    w=tf.get_variable("w", [x.get_shape()[1], output_dim])
+    if quantizeWeights:
+        w=int8_weight((x.get_shape()[1].value, output_dim), tf.get_variable_scope().name + "/w")
+    else:
+        w=tf.get_variable("w", [x.get_shape()[1], output_dim])
     b=tf.get_variable("b", [output_dim], initializer=tf.constant_initializer(0.0))
-    return tf.matmul(x,w)+b
+    return glimpse_matmul(x,w)+b
+
+
+def core_network(hiddenState_prev, glimpse, reuse):
+    # the next hidden state is a function of the previous hidden state and the current glimpse
+    with tf.variable_scope("coreNetwork", reuse=reuse):
+        return tf.nn.relu(affineTransform(hiddenState_prev, cell_size) + (glimpse_matmul(glimpse, Wc_g_h) + Bc_g_h))
 
 
 def model():
-    # initialize the location under unif[-1,1], for all example in the batch
-    initial_loc = tf.random_uniform((batch_size, 2), minval=-1, maxval=1)
+    # the batch dimension is only known when the graph is run
+    n_examples = tf.shape(model_inputs)[0]
+
+    # initialize the location under unif[-1,1], for all example in the batch (at the center without sampling)
+    initial_loc = tf.cond(loc_sampling,
+                          lambda: tf.random_uniform((n_examples, 2), minval=-1, maxval=1),
+                          lambda: tf.zeros((n_examples, 2)))
     mean_locs.append(initial_loc)
-    initial_loc = tf.tanh(initial_loc + tf.random_normal(initial_loc.get_shape(), 0, loc_sd))
+    initial_loc = tf.cond(loc_sampling,
+                          lambda: tf.tanh(initial_loc + tf.random_normal(tf.shape(initial_loc), 0, loc_sd)),
+                          lambda: initial_loc)
     sampled_locs.append(initial_loc)
 
     # get the input using the input network
@@ -227,14 +387,12 @@ def model():
     REUSE = None
     for t in range(nGlimpses):
         if t == 0:  # initialize the hidden state to be the zero vector
-            hiddenState_prev = tf.zeros((batch_size, cell_size))
+            hiddenState_prev = tf.zeros((n_examples, cell_size))
         else:
             hiddenState_prev = outputs[t-1]
 
         # forward prop
-        with tf.variable_scope("coreNetwork", reuse=REUSE):
-            # the next hidden state is a function of the previous hidden state and the current glimpse
-            hiddenState = tf.nn.relu(affineTransform(hiddenState_prev, cell_size) + (tf.matmul(glimpse, Wc_g_h) + Bc_g_h))
+        hiddenState = core_network(hiddenState_prev, glimpse, REUSE)
 
         # save the current glimpse and the hidden state
         inputs[t] = glimpse
@@ -255,7 +413,7 @@ def dense_to_one_hot(labels_dense, num_classes=10):
     # copied from TensorFlow tutorial
     num_labels = labels_dense.shape[0]
     index_offset = np.arange(num_labels) * num_classes
-    labels_one_hot = np.zeros((num_labels, num_classes))
+    labels_one_hot = np.zeros((num_labels, num_classes), dtype=np.float32)
     labels_one_hot.flat[index_offset + labels_dense.ravel()] = 1
     return labels_one_hot
 
@@ -271,12 +429,12 @@ def calc_reward(outputs):
 
     # consider the action at the last time step
     outputs = outputs[-1] # look at ONLY THE END of the sequence
-    outputs = tf.reshape(outputs, (batch_size, cell_out_size))
+    outputs = tf.reshape(outputs, (-1, cell_out_size))
 
     # get the baseline
     b = tf.stack(baselines)
     b = tf.concat(axis=2, values=[b, b])
-    b = tf.reshape(b, (batch_size, (nGlimpses) * 2))
+    b = tf.reshape(b, (-1, (nGlimpses) * 2))
     no_grad_b = tf.stop_gradient(b)
 
     # get the action(classification)
@@ -287,14 +445,14 @@ def calc_reward(outputs):
     # reward for all examples in the batch
     R = tf.cast(tf.equal(max_p_y, correct_y), tf.float32)
     reward = tf.reduce_mean(R) # mean reward
-    R = tf.reshape(R, (batch_size, 1))
+    R = tf.reshape(R, (-1, 1))
     R = tf.tile(R, [1, (nGlimpses)*2])
 
     # get the location
     p_loc = gaussian_pdf(mean_locs, sampled_locs)
     p_loc = tf.tanh(p_loc)
     p_loc_orig = p_loc
-    p_loc = tf.reshape(p_loc, (batch_size, (nGlimpses) * 2))
+    p_loc = tf.reshape(p_loc, (-1, (nGlimpses) * 2))
 
     # define the cost function
     J = tf.concat(axis=1, values=[tf.log(p_y + SMALL_NUM) * (onehot_labels_placeholder), tf.log(p_loc + SMALL_NUM) * (R - no_grad_b)])
@@ -310,11 +468,48 @@ def calc_reward(outputs):
     return cost, reward, max_p_y, correct_y, train_op, b, tf.reduce_mean(b), tf.reduce_mean(R - b), lr
 
 
+def mc_predict(outputs):
+    '''
+    Average the class probabilities over the mc_samples copies of every example
+    :return: the averaged probabilities (batch_size, n_classes) and the predicted labels
+    '''
+    # the copies are stacked batch after batch, see model_inputs
+    p_y = tf.nn.softmax(tf.matmul(outputs[-1], Wa_h_a) + Ba_h_a)
+    p_y = tf.reduce_mean(tf.reshape(p_y, (mc_samples, -1, n_classes)), 0, name="p_y")
+    return p_y, tf.argmax(p_y, 1, name="predicted_labels")
+
+
+def early_exit_step():
+    '''
+    One glimpse of the model for a batch of examples, the loop over the glimpses is run from the host
+    (see early_exit_batch), so that the batch can shrink from one glimpse to the next
+    :return: the placeholders (images, location, previous hidden state) and the new hidden state, the class
+    probabilities and the next location
+    '''
+    images = tf.placeholder(tf.float32, shape=(None, img_size * img_size), name="step_images")
+    loc = tf.placeholder(tf.float32, shape=(None, 2), name="step_loc")
+    hiddenState_prev = tf.placeholder(tf.float32, shape=(None, cell_size), name="step_hidden")
+
+    glimpse = glimpse_network(glimpseSensor(images, loc), loc)
+    hiddenState = core_network(hiddenState_prev, glimpse, True)
+    p_y = tf.nn.softmax(tf.matmul(hiddenState, Wa_h_a) + Ba_h_a)
+
+    # same location policy as get_next_input
+    if eyeCentered:
+        mean_loc = tf.maximum(-1.0, tf.minimum(1.0, tf.matmul(hiddenState, Wl_h_l) + loc))
+    else:
+        mean_loc = tf.matmul(hiddenState, Wl_h_l)
+    next_loc = tf.cond(loc_sampling,
+                       lambda: tf.maximum(-1.0, tf.minimum(1.0, mean_loc + tf.random_normal(tf.shape(mean_loc), 0, loc_sd))),
+                       lambda: tf.maximum(-1.0, tf.minimum(1.0, mean_loc)))
+    return (images, loc, hiddenState_prev), (hiddenState, p_y, next_loc)
+
+
 def preTrain(outputs):
     lr_r = 1e-3
     # consider the action at the last time step
     outputs = outputs[-1] # look at ONLY THE END of the sequence
-    outputs = tf.reshape(outputs, (batch_size, cell_out_size))
+    outputs = tf.reshape(outputs, (-1, cell_out_size))
     # if preTraining:
     reconstruction = tf.sigmoid(tf.matmul(outputs, Wr_h_r) + Br_h_r)
     reconstructionCost = tf.reduce_mean(tf.square(inputs_placeholder - reconstruction))
@@ -324,42 +519,528 @@ def preTrain(outputs):
 
 
 
-def evaluate():
-    data = dataset.test
-    batches_in_epoch = len(data._images) // batch_size
-    accuracy = 0
-
-    for i in xrange(batches_in_epoch):
-        nextX, nextY = dataset.test.next_batch(batch_size)
+def get_eval_inputs():
+    '''
+    The whole test set as model inputs, built on the first call and kept for later evaluations
+    :return: (n_test, img_size**2) float32 images and the labels
+    '''
+    global eval_inputs
+    if eval_inputs is None:
+        eval_inputs = dataset.test.images
         if translateMnist:
-            nextX, _ = convertTranslated(nextX, MNIST_SIZE, img_size)
-        feed_dict = {inputs_placeholder: nextX, labels_placeholder: nextY,
-                     onehot_labels_placeholder: dense_to_one_hot(nextY)}
-        r = sess.run(reward, feed_dict=feed_dict)
-        accuracy += r
+            # fixed offsets, so that accuracies of different steps and runs are comparable
+            eval_inputs, _ = convertTranslated(eval_inputs, MNIST_SIZE, img_size, rng=np.random.RandomState(evalSeed))
+    return eval_inputs, dataset.test.labels
+
 
-    accuracy /= batches_in_epoch
+def evaluate(predict=None):
+    '''
+    Score the whole test set in batches of eval_batch_size
+    :param predict: function from a batch of images to their predicted labels, the model of sess by default
+    :return: the accuracy and the median batch latency in seconds
+    '''
+    if predict is None:
+        def predict(batch):
+            return sess.run(mc_predicted_labels, feed_dict={inputs_placeholder: batch, mc_samples: evalSamples,
+                                                            loc_sampling: evalSampling})
+
+    images, labels = get_eval_inputs()
+    n_correct = 0
+    latencies = []
+
+    start_time = time.time()
+    # slice the test set directly (no next_batch), so the last partial batch is scored too
+    for start in xrange(0, len(labels), eval_batch_size):
+        batch_start = time.time()
+        predicted = predict(images[start:start + eval_batch_size])
+        latencies.append(time.time() - batch_start)
+        n_correct += np.sum(predicted == labels[start:start + eval_batch_size])
+    duration = time.time() - start_time
+
+    accuracy = float(n_correct) / len(labels)
+    p50, p90, p99 = 1000 * np.percentile(latencies, [50, 90, 99])
     print("ACCURACY: " + str(accuracy))
+    print('%.1f examples/sec, batch latency p50 = %.1f ms, p90 = %.1f ms, p99 = %.1f ms (batch size %d, %d samples)'
+          % (len(labels) / duration, p50, p90, p99, eval_batch_size, evalSamples))
+    return accuracy, p50 / 1000
 
 
-def convertTranslated(images, initImgSize, finalImgSize):
+def convertTranslated(images, initImgSize, finalImgSize, out=None, rng=np.random):
+    '''
+    Paste every image of the batch at a random position of an empty (finalImgSize x finalImgSize) canvas
+    :param images: (n_images, initImgSize**2) array
+    :param out: optional C-contiguous float32 buffer of shape (n_images, finalImgSize**2), overwritten and returned
+    :param rng: the numpy.random.RandomState the positions are drawn from
+    :return: the (n_images, finalImgSize**2) float32 canvases and the (n_images, 2) row/column offsets
+    '''
     size_diff = finalImgSize - initImgSize
-    newimages = np.zeros([batch_size, finalImgSize*finalImgSize])
-    imgCoord = np.zeros([batch_size,2])
-    for k in xrange(batch_size):
-        image = images[k, :]
-        image = np.reshape(image, (initImgSize, initImgSize))
-        # generate and save random coordinates
-        randX = random.randint(0, size_diff)
-        randY = random.randint(0, size_diff)
-        imgCoord[k,:] = np.array([randX, randY])
-        # padding
-        image = np.lib.pad(image, ((randX, size_diff - randX), (randY, size_diff - randY)), 'constant', constant_values = (0))
-        newimages[k, :] = np.reshape(image, (finalImgSize*finalImgSize))
+    n_images = images.shape[0]
+    if out is None:
+        newimages = np.zeros([n_images, finalImgSize*finalImgSize], dtype=np.float32)
+    else:
+        newimages = out
+        newimages.fill(0)
+
+    # generate and save random coordinates
+    imgCoord = rng.randint(0, size_diff + 1, size=(n_images, 2))
+
+    # write the whole batch with one fancy-indexed assignment instead of padding each image
+    rows = imgCoord[:, 0, None] + np.arange(initImgSize)
+    cols = imgCoord[:, 1, None] + np.arange(initImgSize)
+    canvas = newimages.reshape(n_images, finalImgSize, finalImgSize)
+    canvas[np.arange(n_images)[:, None, None], rows[:, :, None], cols[:, None, :]] = \
+        np.reshape(images, (n_images, initImgSize, initImgSize))
 
     return newimages, imgCoord
 
 
+def prepare_batch(data, n, out=None):
+    '''
+    Draw the next n examples from a tf_mnist_loader.DataSet and turn them into model inputs
+    :param out: optional float32 buffer of shape (n, img_size**2) for the images
+    :return: images, labels, one-hot labels
+    '''
+    if translateMnist:
+        nextX, nextY = data.next_batch(n)
+        nextX, _ = convertTranslated(nextX, MNIST_SIZE, img_size, out=out)
+    else:
+        # the images are already model inputs, normalize them straight into the buffer
+        nextX, nextY = data.next_batch(n, out=out)
+    return nextX, nextY, dense_to_one_hot(nextY)
+
+
+class BatchFeeder(object):
+    '''
+    Hands out prepared training batches. With prefetch > 0, batches are prepared by a background thread and
+    buffered in a queue of that size, so that the next batch is drawn and translated while sess.run works on
+    the current one. With prefetch = 0, every batch is prepared when it is asked for.
+    '''
+
+    def __init__(self, data, n, prefetch):
+        self.data = data
+        self.n = n
+        self.prefetch = prefetch
+        # a batch must not be overwritten while it is queued, being filled or being used by the training step
+        self.buffers = [np.zeros((n, img_size * img_size), dtype=np.float32) for _ in xrange(prefetch + 2)]
+        self.next_buffer = 0
+        # the read position of data after the last batch handed out (batches in the queue are not counted)
+        self.state = data.get_state()
+
+        if prefetch:
+            self.queue = queue.Queue(maxsize=prefetch)
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self.produce)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def prepare(self):
+        out = self.buffers[self.next_buffer]
+        self.next_buffer = (self.next_buffer + 1) % len(self.buffers)
+        batch = prepare_batch(self.data, self.n, out=out)
+        return batch, self.data.get_state()
+
+    def produce(self):
+        while not self.stop_event.is_set():
+            try:
+                batch = self.prepare()
+            except Exception as e:
+                # hand the error over to the training loop instead of dying silently
+                batch = e
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(batch, Exception):
+                return
+
+    def next_batch(self):
+        if not self.prefetch:
+            batch, self.state = self.prepare()
+            return batch
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        batch, self.state = item
+        return batch
+
+    def close(self):
+        if self.prefetch:
+            self.stop_event.set()
+            self.thread.join()
+
+
+def benchmark_feeding(n_steps=1000):
+    '''
+    Measure training throughput with serial batch preparation and with the background prefetcher
+    '''
+    results = []
+    for prefetch in [0, prefetchBatches]:
+        feeder = BatchFeeder(dataset.train, batch_size, prefetch)
+        # warm up, so that the first steps do not count graph setup
+        for i in xrange(10):
+            nextX, nextY, nextY_onehot = feeder.next_batch()
+            sess.run(train_op, feed_dict={inputs_placeholder: nextX, labels_placeholder: nextY,
+                                          onehot_labels_placeholder: nextY_onehot})
+
+        start_time = time.time()
+        for i in xrange(n_steps):
+            nextX, nextY, nextY_onehot = feeder.next_batch()
+            sess.run(train_op, feed_dict={inputs_placeholder: nextX, labels_placeholder: nextY,
+                                          onehot_labels_placeholder: nextY_onehot})
+        duration = time.time() - start_time
+        feeder.close()
+
+        results.append(n_steps * batch_size / duration)
+        print('prefetch = %d: %.1f examples/sec (%.2f ms/step)' % (prefetch, results[-1], 1000 * duration / n_steps))
+
+    print('FEEDING SPEEDUP: %.2fx' % (results[1] / results[0]))
+
+
+
+def early_exit_batch(images, threshold):
+    '''
+    Classify a batch, an example stops glimpsing as soon as its top class probability is above threshold
+    The examples that are done are dropped from the batch, so later glimpses only run on the undecided ones.
+    :return: the predicted labels and the number of glimpses spent on every example
+    '''
+    n_images = len(images)
+    predicted = np.zeros(n_images, dtype=np.int64)
+    n_glimpses = np.zeros(n_images, dtype=np.int64)
+
+    # same initial location as model()
+    if evalSampling:
+        loc = np.tanh(np.random.uniform(-1, 1, (n_images, 2)) + np.random.normal(0, loc_sd, (n_images, 2)))
+    else:
+        loc = np.zeros((n_images, 2))
+    hiddenState = np.zeros((n_images, cell_size), dtype=np.float32)
+    active = np.arange(n_images)
+
+    for t in xrange(nGlimpses):
+        feed_dict = {step_images: images, step_loc: loc, step_hidden: hiddenState, loc_sampling: evalSampling}
+        hiddenState, p_y, loc = sess.run(step_outputs, feed_dict=feed_dict)
+
+        done = p_y.max(1) > threshold if t < nGlimpses - 1 else np.ones(len(active), dtype=bool)
+        predicted[active[done]] = p_y[done].argmax(1)
+        n_glimpses[active[done]] = t + 1
+
+        # compact the batch to the examples that keep glimpsing
+        keep = ~done
+        active, images, hiddenState, loc = active[keep], images[keep], hiddenState[keep], loc[keep]
+        if len(active) == 0:
+            break
+
+    return predicted, n_glimpses
+
+
+def early_exit_evaluate():
+    '''
+    Score the test set with early exit at every threshold of earlyExitThresholds
+    Prints the accuracy vs compute (glimpses per example) curve, threshold 1.0 never exits early.
+    '''
+    images, labels = get_eval_inputs()
+    print('threshold  accuracy  glimpses/example  examples/sec')
+    for threshold in earlyExitThresholds:
+        n_correct = 0
+        total_glimpses = 0
+        start_time = time.time()
+        for start in xrange(0, len(labels), eval_batch_size):
+            predicted, n_glimpses = early_exit_batch(images[start:start + eval_batch_size], threshold)
+            n_correct += np.sum(predicted == labels[start:start + eval_batch_size])
+            total_glimpses += np.sum(n_glimpses)
+        duration = time.time() - start_time
+        print('%9.3f  %8.4f  %16.2f  %12.1f' % (threshold, float(n_correct) / len(labels),
+                                                float(total_glimpses) / len(labels), len(labels) / duration))
+
+
+def restore_latest_checkpoint():
+    '''
+    Restore the variables from the newest checkpoint in save_dir
+    :return: the checkpoint path
+    '''
+    checkpoint = tf.train.latest_checkpoint(save_dir)
+    if checkpoint is None:
+        raise IOError('No checkpoint in ' + save_dir)
+    saver.restore(sess, checkpoint)
+    if quantizeWeights:
+        quantize_weights(checkpoint)
+    return checkpoint
+
+
+def export_graph():
+    '''
+    Write the latest checkpoint as a frozen graph with only the inference path
+    Inputs: images (and optionally mc_samples, loc_sampling), outputs: p_y, predicted_labels, glimpse_locations.
+    '''
+    checkpoint = restore_latest_checkpoint()
+    n_nodes = frozen_graph.export(sess, ["p_y", "predicted_labels", "glimpse_locations"], exportPath)
+    print("Froze %s into %s (%d nodes)" % (checkpoint, exportPath, n_nodes))
+
+    # the deterministic trajectories, so that both graphs look at the same places
+    images = get_eval_inputs()[0][:eval_batch_size]
+    differences = frozen_graph.check(sess, exportPath, ["p_y", "glimpse_locations"],
+                                     {"images:0": images, "loc_sampling:0": False})
+    if max(differences) > 1e-4:
+        raise ValueError("%s differs from the checkpoint: max relative difference %g in p_y, %g in glimpse_locations"
+                         % (exportPath, differences[0], differences[1]))
+    print("%s matches the checkpoint on %d test images (max relative difference %g in p_y, %g in glimpse_locations)"
+          % (exportPath, len(images), differences[0], differences[1]))
+
+
+def submit_requests(lines, write):
+    '''
+    Queue every non-empty request line for the batcher, each reply is passed to write as one line
+    Returns when all the requests were answered.
+    '''
+    answered = threading.Semaphore(0)
+    lock = threading.Lock()
+
+    def reply(response):
+        with lock:
+            write(response + '\n')
+        answered.release()
+
+    n_requests = 0
+    for line in lines:
+        if line.strip():
+            serve_queue.put((line, time.time(), reply))
+            n_requests += 1
+    for i in xrange(n_requests):
+        answered.acquire()
+
+
+def write_stdout(line):
+    sys.stdout.write(line)
+    sys.stdout.flush()
+
+
+def serve_stdin():
+    submit_requests(sys.stdin, write_stdout)
+    if not servePort:
+        # nothing else can send requests, let the batcher stop
+        serve_queue.put(None)
+
+
+class ServeHandler(socketserver.StreamRequestHandler):
+    '''
+    A TCP connection to the server: one request per line, the replies are sent back one per line
+    '''
+
+    def handle(self):
+        submit_requests((line.decode() for line in self.rfile), lambda line: self.wfile.write(line.encode()))
+
+
+def classify_requests(batch):
+    '''
+    Run one micro-batch of requests through the forward graph and reply to each of them
+    A request is a JSON object with an optional "id" and either "image" (img_size**2 floats in [0, 1]) or
+    "test_index" (an image of the translated test set).
+    :return: the latencies of the requests, from arrival to reply, in seconds
+    '''
+    images = np.zeros((len(batch), img_size * img_size), dtype=np.float32)
+    ids = [None] * len(batch)
+    errors = {}
+    for i, (line, _, _) in enumerate(batch):
+        try:
+            request = json.loads(line)
+            ids[i] = request.get('id')
+            if 'test_index' in request:
+                test_images = get_eval_inputs()[0]
+                index = request['test_index']
+                if not isinstance(index, numbers.Integral) or isinstance(index, bool) or not 0 <= index < len(test_images):
+                    raise ValueError('test_index must be an integer in [0, %d), got %r' % (len(test_images), index))
+                images[i] = test_images[index]
+            else:
+                image = np.asarray(request['image'], dtype=np.float32)
+                if image.shape != (img_size * img_size,):
+                    raise ValueError('expected %d pixel values, got shape %s' % (img_size * img_size, image.shape))
+                images[i] = image
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            errors[i] = '%s: %s' % (type(e).__name__, e)
+
+    feed_dict = {inputs_placeholder: images, mc_samples: serveSamples, loc_sampling: serveSampling}
+    probabilities, locs = sess.run([mc_p_y, sampled_locs], feed_dict=feed_dict)
+    # the trace of the first copy of every example
+    glimpse_traces = toMnistCoordinates(locs[:len(batch)]).astype(int)
+
+    now = time.time()
+    latencies = []
+    for i, (_, arrival, reply) in enumerate(batch):
+        if i in errors:
+            response = {'id': ids[i], 'error': errors[i]}
+        else:
+            response = {'id': ids[i], 'label': int(np.argmax(probabilities[i])),
+                        'probabilities': probabilities[i].tolist(), 'glimpses': glimpse_traces[i].tolist()}
+        latencies.append(now - arrival)
+        response['latency_ms'] = 1000 * latencies[-1]
+        reply(json.dumps(response))
+    return latencies
+
+
+def report_latencies(latencies):
+    p50, p99 = 1000 * np.percentile(latencies, [50, 99])
+    sys.stderr.write('%d requests: latency p50 = %.2f ms, p99 = %.2f ms\n' % (len(latencies), p50, p99))
+
+
+def serve_requests():
+    '''
+    Classify the requests read from stdin (and from localhost:servePort) with the latest checkpoint
+    Requests are grouped into micro-batches of up to serveBatchSize, a request waits at most serveMaxLatency
+    seconds for others to join its batch. The replies go to stdout (or back over the socket), logs to stderr.
+    '''
+    sys.stderr.write('Serving ' + restore_latest_checkpoint() + '\n')
+    # translate the test set now rather than inside the latency window of the first test_index request
+    get_eval_inputs()
+
+    if servePort:
+        server = socketserver.ThreadingTCPServer(('localhost', servePort), ServeHandler)
+        server.daemon_threads = True
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+        sys.stderr.write('Listening on localhost:%d\n' % servePort)
+    stdin_thread = threading.Thread(target=serve_stdin)
+    stdin_thread.daemon = True
+    stdin_thread.start()
+
+    latencies = []
+    running = True
+    try:
+        while running:
+            first = serve_queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = first[1] + serveMaxLatency
+            while len(batch) < serveBatchSize:
+                try:
+                    item = serve_queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            latencies.extend(classify_requests(batch))
+            if len(latencies) >= serveReportFreq:
+                report_latencies(latencies)
+                latencies = []
+    except KeyboardInterrupt:
+        pass
+    if latencies:
+        report_latencies(latencies)
+
+
+class AsyncCheckpointer(object):
+    '''
+    Writes checkpoints of the training state without stalling the training loop. save() copies the variables into
+    snapshot variables (an in-graph copy) and the read position of the training set into cursor variables, then a
+    background thread writes those to disk while training goes on. The checkpoints use the names of the original
+    variables, so `saver` restores them. Only the newest max_to_keep checkpoints are kept.
+    A failed write is raised by the next save() or wait(), so training does not go on without checkpoints.
+    '''
+
+    def __init__(self, variables, data, max_to_keep):
+        self.data = data
+        self.thread = None
+        self.error = None
+        local = [tf.GraphKeys.LOCAL_VARIABLES]
+
+        with tf.name_scope('snapshot'):
+            snapshots = [tf.Variable(tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype), trainable=False,
+                                     collections=local, name=v.op.name) for v in variables]
+            self.snapshot_op = tf.group(*[tf.assign(s, v) for s, v in zip(snapshots, variables)])
+
+        # DataSet.get_state(), the numpy MT19937 state is split into its fields
+        with tf.name_scope('data_cursor'):
+            self.cursor = dict((name, tf.Variable(tf.zeros(shape, dtype=dtype), trainable=False, collections=local,
+                                                  name=name))
+                               for name, shape, dtype in [('perm', (data.num_examples,), tf.int64),
+                                                          ('index_in_epoch', (), tf.int64),
+                                                          ('epochs_completed', (), tf.int64),
+                                                          ('rng_keys', (624,), tf.int64),
+                                                          ('rng_pos', (), tf.int64),
+                                                          ('rng_has_gauss', (), tf.int64),
+                                                          ('rng_cached_gaussian', (), tf.float64)])
+
+        cursor_list = dict((var.op.name, var) for var in self.cursor.values())
+        var_list = dict((v.op.name, s) for v, s in zip(variables, snapshots))
+        var_list.update(cursor_list)
+        self.saver = tf.train.Saver(var_list, max_to_keep=max_to_keep)
+        self.cursor_saver = tf.train.Saver(cursor_list)
+
+    def save(self, step, data_state):
+        '''
+        Start writing the checkpoint of step, data_state is the read position after the last batch trained on
+        '''
+        # the snapshot must not change while the previous checkpoint is being written
+        self.wait()
+        sess.run(self.snapshot_op)
+        _, keys, pos, has_gauss, cached_gaussian = data_state['rng_state']
+        values = {'perm': data_state['perm'], 'index_in_epoch': data_state['index_in_epoch'],
+                  'epochs_completed': data_state['epochs_completed'], 'rng_keys': keys.astype(np.int64),
+                  'rng_pos': pos, 'rng_has_gauss': has_gauss, 'rng_cached_gaussian': cached_gaussian}
+        for name, value in values.items():
+            self.cursor[name].load(value, sess)
+
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+        self.thread = threading.Thread(target=self.write, args=(step,))
+        self.thread.start()
+
+    def write(self, step):
+        try:
+            self.saver.save(sess, save_dir + save_prefix, global_step=step)
+        except Exception as e:
+            # e.g. a full disk: kept for wait() and the next save(), which stop training with it
+            self.error = e
+
+    def wait(self):
+        '''
+        Block until the checkpoint being written is complete, raise the error if writing it failed
+        '''
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def restore(self, checkpoint):
+        '''
+        Continue reading the training set where checkpoint left off (the variables are restored by `saver`)
+        '''
+        # rotate the checkpoints written before the restart as well
+        state = tf.train.get_checkpoint_state(save_dir)
+        self.saver.recover_last_checkpoints(state.all_model_checkpoint_paths)
+        try:
+            self.cursor_saver.restore(sess, checkpoint)
+        except (tf.errors.NotFoundError, tf.errors.InvalidArgumentError):
+            print("No data cursor in " + checkpoint + ", the training data starts from the beginning")
+            return
+        values = sess.run(self.cursor)
+        rng_state = ('MT19937', values['rng_keys'].astype(np.uint32), int(values['rng_pos']),
+                     int(values['rng_has_gauss']), float(values['rng_cached_gaussian']))
+        self.data.set_state({'perm': values['perm'], 'index_in_epoch': values['index_in_epoch'],
+                             'epochs_completed': values['epochs_completed'], 'rng_state': rng_state})
+
+
+def resume_training():
+    '''
+    Restore the newest checkpoint in save_dir (variables, global step and data cursor), if there is one
+    :return: the step to continue after, 0 without a checkpoint
+    '''
+    checkpoint = tf.train.latest_checkpoint(save_dir)
+    if checkpoint is None:
+        return 0
+    saver.restore(sess, checkpoint)
+    checkpointer.restore(checkpoint)
+    step = sess.run(global_step)
+    print("Resuming from " + checkpoint + " at step " + str(step))
+    return step
+
 
 def toMnistCoordinates(coordinate_tanh):
     '''
@@ -407,31 +1088,40 @@ with tf.Graph().as_default():
     lr = tf.train.exponential_decay(initLr, global_step, lrDecayFreq, lrDecayRate, staircase=True)
 
     # preallocate x, y, baseline
-    labels = tf.placeholder("float32", shape=[batch_size, n_classes])
-    labels_placeholder = tf.placeholder(tf.float32, shape=(batch_size), name="labels_raw")
-    onehot_labels_placeholder = tf.placeholder(tf.float32, shape=(batch_size, 10), name="labels_onehot")
-    inputs_placeholder = tf.placeholder(tf.float32, shape=(batch_size, img_size * img_size), name="images")
+    # the leading (batch) dimension is left open, so any batch size can be fed to the same graph
+    labels = tf.placeholder("float32", shape=[None, n_classes])
+    labels_placeholder = tf.placeholder(tf.float32, shape=(None,), name="labels_raw")
+    onehot_labels_placeholder = tf.placeholder(tf.float32, shape=(None, 10), name="labels_onehot")
+    inputs_placeholder = tf.placeholder(tf.float32, shape=(None, img_size * img_size), name="images")
+
+    # Monte Carlo inference: the model runs on mc_samples copies of the batch in one pass, every copy follows its
+    # own sampled glimpse trajectory. Training leaves both at their defaults.
+    mc_samples = tf.placeholder_with_default(1, shape=(), name="mc_samples")
+    loc_sampling = tf.placeholder_with_default(True, shape=(), name="loc_sampling")
+    model_inputs = tf.tile(inputs_placeholder, [mc_samples, 1])
 
     # declare the model parameters, here're naming rule:
     # the 1st captical letter: weights or bias (W = weights, B = bias)
     # the 2nd lowercase letter: the network (e.g.: g = glimpse network)
     # the 3rd and 4th letter(s): input-output mapping, which is clearly written in the variable name argument
 
+    # 2 inputs, some of them negative: stays float with quantizeWeights
     Wg_l_h = weight_variable((2, hl_size), "glimpseNet_wts_location_hidden", True)
     Bg_l_h = weight_variable((1,hl_size), "glimpseNet_bias_location_hidden", True)
 
-    Wg_g_h = weight_variable((totalSensorBandwidth, hg_size), "glimpseNet_wts_glimpse_hidden", True)
+    Wg_g_h = glimpse_weight((totalSensorBandwidth, hg_size), "glimpseNet_wts_glimpse_hidden")
     Bg_g_h = weight_variable((1,hg_size), "glimpseNet_bias_glimpse_hidden", True)
 
-    Wg_hg_gf1 = weight_variable((hg_size, g_size), "glimpseNet_wts_hiddenGlimpse_glimpseFeature1", True)
-    Wg_hl_gf1 = weight_variable((hl_size, g_size), "glimpseNet_wts_hiddenLocation_glimpseFeature1", True)
+    Wg_hg_gf1 = glimpse_weight((hg_size, g_size), "glimpseNet_wts_hiddenGlimpse_glimpseFeature1")
+    Wg_hl_gf1 = glimpse_weight((hl_size, g_size), "glimpseNet_wts_hiddenLocation_glimpseFeature1")
     Bg_hlhg_gf1 = weight_variable((1,g_size), "glimpseNet_bias_hGlimpse_hLocs_glimpseFeature1", True)
 
-    Wc_g_h = weight_variable((cell_size, g_size), "coreNet_wts_glimpse_hidden", True)
+    Wc_g_h = glimpse_weight((cell_size, g_size), "coreNet_wts_glimpse_hidden")
     Bc_g_h = weight_variable((1,g_size), "coreNet_bias_glimpse_hidden", True)
 
-    Wr_h_r = weight_variable((cell_out_size, img_size**2), "reconstructionNet_wts_hidden_action", True)
-    Br_h_r = weight_variable((1, img_size**2), "reconstructionNet_bias_hidden_action", True)
+    if not forward_only:
+        Wr_h_r = weight_variable((cell_out_size, img_size**2), "reconstructionNet_wts_hidden_action", True)
+        Br_h_r = weight_variable((1, img_size**2), "reconstructionNet_bias_hidden_action", True)
 
     Wb_h_b = weight_variable((g_size, 1), "baselineNet_wts_hiddenState_baseline", True)
     Bb_h_b = weight_variable((1,1), "baselineNet_bias_hiddenState_baseline", True)
@@ -446,59 +1136,88 @@ with tf.Graph().as_default():
 
     # convert list of tensors to one big tensor
     sampled_locs = tf.concat(axis=0, values=sampled_locs)
-    sampled_locs = tf.reshape(sampled_locs, (nGlimpses, batch_size, 2))
-    sampled_locs = tf.transpose(sampled_locs, [1, 0, 2])
+    sampled_locs = tf.reshape(sampled_locs, (nGlimpses, -1, 2))
+    sampled_locs = tf.transpose(sampled_locs, [1, 0, 2], name="glimpse_locations")
     mean_locs = tf.concat(axis=0, values=mean_locs)
-    mean_locs = tf.reshape(mean_locs, (nGlimpses, batch_size, 2))
+    mean_locs = tf.reshape(mean_locs, (nGlimpses, -1, 2))
     mean_locs = tf.transpose(mean_locs, [1, 0, 2])
     glimpse_images = tf.concat(axis=0, values=glimpse_images)
 
 
 
-    # compute the reward
-    reconstructionCost, reconstruction, train_op_r = preTrain(outputs)
-    cost, reward, predicted_labels, correct_labels, train_op, b, avg_b, rminusb, lr = calc_reward(outputs)
+    # average the class probabilities of the Monte Carlo samples
+    mc_p_y, mc_predicted_labels = mc_predict(outputs)
 
-    # tensorboard visualization for the parameters
-    variable_summaries(Wg_l_h, "glimpseNet_wts_location_hidden")
-    variable_summaries(Bg_l_h, "glimpseNet_bias_location_hidden")
-    variable_summaries(Wg_g_h, "glimpseNet_wts_glimpse_hidden")
-    variable_summaries(Bg_g_h, "glimpseNet_bias_glimpse_hidden")
-    variable_summaries(Wg_hg_gf1, "glimpseNet_wts_hiddenGlimpse_glimpseFeature1")
-    variable_summaries(Wg_hl_gf1, "glimpseNet_wts_hiddenLocation_glimpseFeature1")
-    variable_summaries(Bg_hlhg_gf1, "glimpseNet_bias_hGlimpse_hLocs_glimpseFeature1")
+    # a single glimpse step, to stop glimpsing at the examples that are already classified
+    if earlyExit:
+        (step_images, step_loc, step_hidden), step_outputs = early_exit_step()
 
-    variable_summaries(Wc_g_h, "coreNet_wts_glimpse_hidden")
-    variable_summaries(Bc_g_h, "coreNet_bias_glimpse_hidden")
+    # the training graph, serving and the exported graph only need the forward pass above
+    if not forward_only:
+        # compute the reward
+        reconstructionCost, reconstruction, train_op_r = preTrain(outputs)
+        cost, reward, predicted_labels, correct_labels, train_op, b, avg_b, rminusb, lr = calc_reward(outputs)
 
-    variable_summaries(Wb_h_b, "baselineNet_wts_hiddenState_baseline")
-    variable_summaries(Bb_h_b, "baselineNet_bias_hiddenState_baseline")
+        # tensorboard visualization for the parameters
+        variable_summaries(Wg_l_h, "glimpseNet_wts_location_hidden")
+        variable_summaries(Bg_l_h, "glimpseNet_bias_location_hidden")
+        variable_summaries(Wg_g_h, "glimpseNet_wts_glimpse_hidden")
+        variable_summaries(Bg_g_h, "glimpseNet_bias_glimpse_hidden")
+        variable_summaries(Wg_hg_gf1, "glimpseNet_wts_hiddenGlimpse_glimpseFeature1")
+        variable_summaries(Wg_hl_gf1, "glimpseNet_wts_hiddenLocation_glimpseFeature1")
+        variable_summaries(Bg_hlhg_gf1, "glimpseNet_bias_hGlimpse_hLocs_glimpseFeature1")
 
-    variable_summaries(Wl_h_l, "locationNet_wts_hidden_location")
+        variable_summaries(Wc_g_h, "coreNet_wts_glimpse_hidden")
+        variable_summaries(Bc_g_h, "coreNet_bias_glimpse_hidden")
 
-    variable_summaries(Wa_h_a, 'actionNet_wts_hidden_action')
-    variable_summaries(Ba_h_a, 'actionNet_bias_hidden_action')
+        variable_summaries(Wb_h_b, "baselineNet_wts_hiddenState_baseline")
+        variable_summaries(Bb_h_b, "baselineNet_bias_hiddenState_baseline")
 
-    # tensorboard visualization for the performance metrics
-    tf.summary.scalar("reconstructionCost", reconstructionCost)
-    tf.summary.scalar("reward", reward)
-    tf.summary.scalar("cost", cost)
-    tf.summary.scalar("mean(b)", avg_b)
-    tf.summary.scalar("mean(R - b)", rminusb)
-    summary_op = tf.summary.merge_all()
+        variable_summaries(Wl_h_l, "locationNet_wts_hidden_location")
+
+        variable_summaries(Wa_h_a, 'actionNet_wts_hidden_action')
+        variable_summaries(Ba_h_a, 'actionNet_bias_hidden_action')
+
+        # tensorboard visualization for the performance metrics
+        tf.summary.scalar("reconstructionCost", reconstructionCost)
+        tf.summary.scalar("reward", reward)
+        tf.summary.scalar("cost", cost)
+        tf.summary.scalar("mean(b)", avg_b)
+        tf.summary.scalar("mean(R - b)", rminusb)
+        summary_op = tf.summary.merge_all()
 
 
     ####################################### START RUNNING THE MODEL #######################################
     sess = tf.Session()
     saver = tf.train.Saver()
+    if not forward_only:
+        checkpointer = AsyncCheckpointer(tf.global_variables(), dataset.train, keepCheckpoints)
     b_fetched = np.zeros((batch_size, (nGlimpses)*2))
 
     init = tf.global_variables_initializer()
     sess.run(init)
 
-    if eval_only:
+    if earlyExit:
+        sys.stderr.write('Scoring ' + restore_latest_checkpoint() + '\n')
+        early_exit_evaluate()
+    elif exportGraph:
+        export_graph()
+    elif serve:
+        serve_requests()
+    elif quantizeWeights:
+        compare_quantized()
+    elif eval_only:
+        sys.stderr.write('Scoring ' + restore_latest_checkpoint() + '\n')
         evaluate()
+    elif benchmarkFeeding:
+        benchmark_feeding()
     else:
+        # the data cursor has to be restored before the feeder starts reading
+        start_step = resume_training() if resume else 0
+
+        # the same feeder serves the pretraining and the training phase
+        feeder = BatchFeeder(dataset.train, batch_size, prefetchBatches)
+
         summary_writer = tf.summary.FileWriter(summaryFolderName, graph=sess.graph)
 
         if draw:
@@ -515,21 +1234,25 @@ with tf.Graph().as_default():
             plt.ion()
             plt.show()
 
-        if preTraining:
+        # a resumed run is past the pretraining
+        if preTraining and start_step == 0:
             for epoch_r in xrange(1,preTraining_epoch):
-                nextX, _ = dataset.train.next_batch(batch_size)
-                nextX_orig = nextX
-                if translateMnist:
-                    nextX, _ = convertTranslated(nextX, MNIST_SIZE, img_size)
+                nextX, _, _ = feeder.next_batch()
 
-                fetches_r = [reconstructionCost, reconstruction, train_op_r]
+                # the reconstructed images are only copied to the host when they are drawn
+                draw_step = drawReconsturction and epoch_r % 100 == 0
+                fetches_r = [reconstructionCost, train_op_r]
+                if draw_step:
+                    fetches_r.append(reconstruction)
 
-                reconstructionCost_fetched, reconstruction_fetched, train_op_r_fetched = sess.run(fetches_r, feed_dict={inputs_placeholder: nextX})
+                results_r = sess.run(fetches_r, feed_dict={inputs_placeholder: nextX})
+                reconstructionCost_fetched = results_r[0]
 
                 if epoch_r % 20 == 0:
                     print('Step %d: reconstructionCost = %.5f' % (epoch_r, reconstructionCost_fetched))
                     if epoch_r % 100 == 0:
-                        if drawReconsturction:
+                        if draw_step:
+                            reconstruction_fetched = results_r[2]
                             fig = plt.figure(2)
 
                             plt.subplot(1, 2, 1)
@@ -549,41 +1272,44 @@ with tf.Graph().as_default():
 
 
         # training
+        # fetch plan: every step runs the update and reads the scalar metrics, logging steps also read the
+        # summaries and the tensors used for drawing, from the same forward pass
+        scalar_fetches = [train_op, cost, reward, avg_b, rminusb, lr]
+        diagnostic_fetches = [summary_op, predicted_labels, correct_labels, glimpse_images, mean_locs, sampled_locs]
         for epoch in xrange(start_step + 1, max_iters):
             start_time = time.time()
 
             # get the next batch of examples
-            nextX, nextY = dataset.train.next_batch(batch_size)
-            nextX_orig = nextX
-            if translateMnist:
-                nextX, nextX_coord = convertTranslated(nextX, MNIST_SIZE, img_size)
+            nextX, nextY, nextY_onehot = feeder.next_batch()
 
             feed_dict = {inputs_placeholder: nextX, labels_placeholder: nextY, \
-                         onehot_labels_placeholder: dense_to_one_hot(nextY)}
+                         onehot_labels_placeholder: nextY_onehot}
 
-            fetches = [train_op, cost, reward, predicted_labels, correct_labels, glimpse_images, avg_b, rminusb, \
-                       mean_locs, sampled_locs, lr]
+            # only logging steps pay for copying the diagnostic tensors to the host
+            logging_step = epoch % logFreq == 0
+            fetches = scalar_fetches + diagnostic_fetches if logging_step else scalar_fetches
             # feed them to the model
             results = sess.run(fetches, feed_dict=feed_dict)
 
-            _, cost_fetched, reward_fetched, prediction_labels_fetched, correct_labels_fetched, glimpse_images_fetched, \
-            avg_b_fetched, rminusb_fetched, mean_locs_fetched, sampled_locs_fetched, lr_fetched = results
+            _, cost_fetched, reward_fetched, avg_b_fetched, rminusb_fetched, lr_fetched = results[:len(scalar_fetches)]
 
 
             duration = time.time() - start_time
 
-            if epoch % 20 == 0:
+            if epoch % saveFreq == 0:
+                checkpointer.save(epoch, feeder.state)
+                evaluate()
+
+            if logging_step:
+                summary_str, prediction_labels_fetched, correct_labels_fetched, glimpse_images_fetched, \
+                mean_locs_fetched, sampled_locs_fetched = results[len(scalar_fetches):]
+
                 print('Step %d: cost = %.5f reward = %.5f (%.3f sec) b = %.5f R-b = %.5f, LR = %.5f'
                       % (epoch, cost_fetched, reward_fetched, duration, avg_b_fetched, rminusb_fetched, lr_fetched))
-                summary_str = sess.run(summary_op, feed_dict=feed_dict)
                 summary_writer.add_summary(summary_str, epoch)
                 # if saveImgs:
                 #     plt.savefig(imgsFolderName + simulationName + '_ep%.6d.png' % (epoch))
 
-                if epoch % 5000 == 0:
-                    saver.save(sess, save_dir + save_prefix + str(epoch) + ".ckpt")
-                    evaluate()
-
                 ##### DRAW WINDOW ################
                 f_glimpse_images = np.reshape(glimpse_images_fetched, \
                                               (nGlimpses, batch_size, depth, sensorBandwidth, sensorBandwidth))
@@ -632,4 +1358,7 @@ with tf.Graph().as_default():
                         time.sleep(0.05)
                         plt.pause(0.0001)
 
+        feeder.close()
+        checkpointer.wait()
+
     sess.close()
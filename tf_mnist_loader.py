@@ -51,11 +51,11 @@ def extract_images(filename):
     data = numpy.frombuffer(buf, dtype=numpy.uint8)
     data = data.reshape(num_images, rows, cols, 1)
     return data
-def dense_to_one_hot(labels_dense, num_classes=10):
+def dense_to_one_hot(labels_dense, num_classes=10, dtype=numpy.float64):
   """Convert class labels from scalars to one-hot vectors."""
   num_labels = labels_dense.shape[0]
   index_offset = numpy.arange(num_labels) * num_classes
-  labels_one_hot = numpy.zeros((num_labels, num_classes))
+  labels_one_hot = numpy.zeros((num_labels, num_classes), dtype=dtype)
   labels_one_hot.flat[index_offset + labels_dense.ravel()] = 1
   return labels_one_hot
 def extract_labels(filename, one_hot=False):
@@ -73,9 +73,33 @@ def extract_labels(filename, one_hot=False):
     if one_hot:
       return dense_to_one_hot(labels)
     return labels
+def maybe_cache(filename, work_directory, extract):
+  """Decode an MNIST file into an uncompressed uint8 .npy cache, unless it's
+  already there, and memory-map the cache read-only."""
+  cache_path = os.path.join(work_directory, filename.replace('.gz', '.npy'))
+  if not os.path.exists(cache_path):
+    data = extract(maybe_download(filename, work_directory))
+    # Write under a temporary name, so an interrupted conversion is never
+    # mistaken for a complete cache.
+    with open(cache_path + '.tmp', 'wb') as f:
+      numpy.save(f, data)
+    os.rename(cache_path + '.tmp', cache_path)
+  return numpy.load(cache_path, mmap_mode='r')
 class DataSet(object):
-  def __init__(self, images, labels, fake_data=False, one_hot=False):
-    """Construct a DataSet. one_hot arg is used only if fake_data is true."""
+  def __init__(self, images, labels, fake_data=False, one_hot=False,
+               storage='float32', drop_remainder=True, seed=None):
+    """Construct a DataSet. one_hot arg is used only if fake_data is true.
+    With storage='uint8' the images are kept as given (e.g. a uint8 memmap),
+    at a quarter of the float32 memory, and each batch is converted to
+    float32 in [0.0, 1.0] by next_batch.
+    With drop_remainder=False the batch that crosses an epoch boundary is
+    filled up from the next epoch instead of skipping the rest of the epoch.
+    A seed gives a reproducible shuffle stream, independent of numpy.random.
+    """
+    if storage not in ('float32', 'uint8'):
+      raise ValueError('Invalid storage %r, expected float32 or uint8' %
+                       storage)
+    self._storage = storage
     if fake_data:
       self._num_examples = 10000
       self.one_hot = one_hot
@@ -89,16 +113,23 @@ class DataSet(object):
       assert images.shape[3] == 1
       images = images.reshape(images.shape[0],
                               images.shape[1] * images.shape[2])
-      # Convert from [0, 255] -> [0.0, 1.0].
-      images = images.astype(numpy.float32)
-      images = numpy.multiply(images, 1.0 / 255.0)
+      if storage == 'float32':
+        # Convert from [0, 255] -> [0.0, 1.0].
+        images = images.astype(numpy.float32)
+        images = numpy.multiply(images, 1.0 / 255.0)
     self._images = images
     self._labels = labels
     self._epochs_completed = 0
     self._index_in_epoch = 0
+    # Batches are gathered through this permutation, so shuffling never
+    # moves the images. The first epoch is read in order.
+    self._perm = numpy.arange(self._num_examples)
+    self._drop_remainder = drop_remainder
+    self._rng = numpy.random if seed is None else numpy.random.RandomState(seed)
   @property
   def images(self):
-    return self._images
+    """All images as float32; with uint8 storage this converts a full copy."""
+    return self._to_float(self._images)
   @property
   def labels(self):
     return self._labels
@@ -108,8 +139,34 @@ class DataSet(object):
   @property
   def epochs_completed(self):
     return self._epochs_completed
-  def next_batch(self, batch_size, fake_data=False):
-    """Return the next `batch_size` examples from this data set."""
+  def get_state(self):
+    """Return the read position, for set_state() to continue from it later.
+    The permutation is not copied, it is replaced (never modified) when the
+    next epoch starts.
+    """
+    return {'perm': self._perm, 'index_in_epoch': self._index_in_epoch,
+            'epochs_completed': self._epochs_completed,
+            'rng_state': self._rng.get_state()}
+  def set_state(self, state):
+    """Continue reading from a position returned by get_state()."""
+    assert len(state['perm']) == self._num_examples
+    self._perm = numpy.asarray(state['perm'])
+    self._index_in_epoch = int(state['index_in_epoch'])
+    self._epochs_completed = int(state['epochs_completed'])
+    self._rng.set_state(state['rng_state'])
+  def _to_float(self, images, out=None):
+    """Convert stored images from [0, 255] -> [0.0, 1.0] if needed."""
+    if self._storage == 'float32':
+      if out is None:
+        return images
+      out[...] = images
+      return out
+    return numpy.multiply(images, 1.0 / 255.0, out=out, dtype=numpy.float32)
+  def next_batch(self, batch_size, fake_data=False, out=None):
+    """Return the next `batch_size` examples from this data set.
+    The images are written to `out` if given, a float32 array of shape
+    [batch_size, rows*columns] that the caller can reuse across batches.
+    """
     if fake_data:
       fake_image = [1] * 784
       if self.one_hot:
@@ -123,18 +180,30 @@ class DataSet(object):
     if self._index_in_epoch > self._num_examples:
       # Finished epoch
       self._epochs_completed += 1
-      # Shuffle the data
-      perm = numpy.arange(self._num_examples)
-      numpy.random.shuffle(perm)
-      self._images = self._images[perm]
-      self._labels = self._labels[perm]
-      # Start next epoch
-      start = 0
-      self._index_in_epoch = batch_size
       assert batch_size <= self._num_examples
-    end = self._index_in_epoch
-    return self._images[start:end], self._labels[start:end]
-def read_data_sets(train_dir, fake_data=False, one_hot=False):
+      if self._drop_remainder:
+        rest = self._perm[:0]
+      else:
+        rest = self._perm[start:]
+      # Shuffle the indices, the data stays where it is
+      self._perm = self._rng.permutation(self._num_examples)
+      # Start next epoch
+      self._index_in_epoch = batch_size - len(rest)
+      index = numpy.concatenate([rest, self._perm[:self._index_in_epoch]])
+    else:
+      index = self._perm[start:self._index_in_epoch]
+    return self._to_float(self._images[index], out=out), self._labels[index]
+def read_data_sets(train_dir, fake_data=False, one_hot=False, cache=False,
+                   drop_remainder=True, seed=None, storage=None):
+  """Read the MNIST train, validation and test sets.
+  storage, drop_remainder and seed are passed on to each DataSet. storage
+  defaults to 'uint8' with cache=True and to 'float32' otherwise. With
+  'uint8' storage one-hot labels are uint8 as well.
+  With cache=True the decoded files are kept as uint8 .npy files in
+  train_dir, memory-mapped on later runs and normalized batch by batch, so
+  that startup does not gunzip and convert the whole data set and parallel
+  workers share the page cache.
+  """
   class DataSets(object):
     pass
   data_sets = DataSets()
@@ -148,19 +217,35 @@ def read_data_sets(train_dir, fake_data=False, one_hot=False):
   TEST_IMAGES = 't10k-images-idx3-ubyte.gz'
   TEST_LABELS = 't10k-labels-idx1-ubyte.gz'
   VALIDATION_SIZE = 5000
-  local_file = maybe_download(TRAIN_IMAGES, train_dir)
-  train_images = extract_images(local_file)
-  local_file = maybe_download(TRAIN_LABELS, train_dir)
-  train_labels = extract_labels(local_file, one_hot=one_hot)
-  local_file = maybe_download(TEST_IMAGES, train_dir)
-  test_images = extract_images(local_file)
-  local_file = maybe_download(TEST_LABELS, train_dir)
-  test_labels = extract_labels(local_file, one_hot=one_hot)
+  if cache:
+    if not os.path.exists(train_dir):
+      os.mkdir(train_dir)
+    train_images = maybe_cache(TRAIN_IMAGES, train_dir, extract_images)
+    train_labels = maybe_cache(TRAIN_LABELS, train_dir, extract_labels)
+    test_images = maybe_cache(TEST_IMAGES, train_dir, extract_images)
+    test_labels = maybe_cache(TEST_LABELS, train_dir, extract_labels)
+    storage = storage or 'uint8'
+  else:
+    local_file = maybe_download(TRAIN_IMAGES, train_dir)
+    train_images = extract_images(local_file)
+    local_file = maybe_download(TRAIN_LABELS, train_dir)
+    train_labels = extract_labels(local_file)
+    local_file = maybe_download(TEST_IMAGES, train_dir)
+    test_images = extract_images(local_file)
+    local_file = maybe_download(TEST_LABELS, train_dir)
+    test_labels = extract_labels(local_file)
+    storage = storage or 'float32'
+  if one_hot:
+    label_dtype = numpy.uint8 if storage == 'uint8' else numpy.float64
+    train_labels = dense_to_one_hot(train_labels, dtype=label_dtype)
+    test_labels = dense_to_one_hot(test_labels, dtype=label_dtype)
   validation_images = train_images[:VALIDATION_SIZE]
   validation_labels = train_labels[:VALIDATION_SIZE]
   train_images = train_images[VALIDATION_SIZE:]
   train_labels = train_labels[VALIDATION_SIZE:]
-  data_sets.train = DataSet(train_images, train_labels)
-  data_sets.validation = DataSet(validation_images, validation_labels)
-  data_sets.test = DataSet(test_images, test_labels)
+  options = dict(storage=storage, drop_remainder=drop_remainder, seed=seed)
+  data_sets.train = DataSet(train_images, train_labels, **options)
+  data_sets.validation = DataSet(validation_images, validation_labels,
+                                 **options)
+  data_sets.test = DataSet(test_images, test_labels, **options)
   return data_sets
\ No newline at end of file